@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import contextlib
+import numpy as np
+import pandas as pd
+from elaborate_2 import extract_subfile, compact_frame, build_aggregate_cube, build_municipality_dim, \
+    compute_productivity_totals, CLIMATE_VARIABLES, ENGINES, pl
+from run_report import RUN_REPORT_FILE, new_run_report, measure_stage, finish_run_report
+import dash_tot
+
+# Size of the dataset at scale 1: one station per municipality of Paraná,
+# with daily data since the start of the NASA POWER agroclimatology series
+REAL_STATIONS = 399
+REAL_YEARS = (1981, 2020)
+PRODUCTIVITY_YEARS = list(range(2004, 2018))
+
+# Multiples of the real size measured by default
+SCALES = [1, 10, 100]
+
+# Fraction of the measurements replaced by the NASA POWER fill value
+FILL_VALUE_RATE = 1e-4
+
+MESOREGIONS = [
+    'Noroeste Paranaense', 'Centro Ocidental Paranaense', 'Norte Central Paranaense',
+    'Norte Pioneiro Paranaense', 'Centro Oriental Paranaense', 'Oeste Paranaense',
+    'Sudoeste Paranaense', 'Centro-Sul Paranaense', 'Sudeste Paranaense', 'Metropolitana de Curitiba',
+]
+
+BENCHMARK_FILE = "benchmark_results.json"
+
+
+def generate_climate_csv(file_path, stations, years, municipalities=None, seed=0, stations_per_block=50):
+    """
+    Write a synthetic CSV file with the columns of the agroclimatology dataset.
+
+    Every station has one row per day. The file is written a block of
+    stations at a time, so its size is not limited by the memory.
+
+    Args:
+    - file_path (str): Path of the CSV file to write.
+    - stations (int): Number of stations.
+    - years (tuple): First and last year of the daily data.
+    - municipalities (int): Number of municipalities, the stations are assigned
+      to them in turn. If None, each station is a municipality.
+    - seed (int): Seed of the random generator.
+    - stations_per_block (int): Number of stations generated and written at once.
+
+    Returns:
+    - int: Number of rows written.
+    """
+    rng = np.random.default_rng(seed)
+    municipalities = municipalities or stations
+    dates = pd.date_range(f'{years[0]}-01-01', f'{years[1]}-12-31', freq='D')
+    data = dates.strftime('%Y%m%d').astype(np.int64).to_numpy()
+    # Seasonal cycle of the southern hemisphere, warmest in January
+    seasonal = np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 15) / 365.25)
+    latitudes = rng.uniform(-26.6, -22.6, stations)
+    longitudes = rng.uniform(-54.5, -48.1, stations)
+    rows = 0
+    for first in range(0, stations, stations_per_block):
+        block = np.arange(first, min(first + stations_per_block, stations))
+        size = len(block) * len(dates)
+        temperature = 20 + 5 * np.tile(seasonal, len(block)) + rng.normal(0, 2, size)
+        df = pd.DataFrame({
+            'codigo_ibge': np.repeat(4100000 + block % municipalities, len(dates)),
+            'data': np.tile(data, len(block)),
+            'latitude': np.repeat(latitudes[block], len(dates)),
+            'longitude': np.repeat(longitudes[block], len(dates)),
+            'PRECTOT': rng.gamma(0.5, 8, size).round(2),
+            'TS': temperature.round(2),
+            'PS': rng.normal(95, 1.5, size).round(2),
+            'QV2M': rng.uniform(5, 18, size).round(2),
+            'GWETROOT': rng.uniform(0.2, 0.9, size).round(2),
+            'T2M': (temperature + rng.normal(0, 1, size)).round(2),
+        })
+        # Missing measurements, as written by NASA POWER
+        for column in CLIMATE_VARIABLES:
+            df.loc[rng.random(size) < FILL_VALUE_RATE, column] = -999
+        df.to_csv(file_path, mode='w' if first == 0 else 'a', header=first == 0, index=False)
+        rows += size
+    return rows
+
+
+def generate_productivity_csv(file_path, municipalities, productivity_years=PRODUCTIVITY_YEARS, seed=0):
+    """
+    Write a synthetic CSV file with the columns of the soybean productivity dataset.
+
+    Args:
+    - file_path (str): Path of the CSV file to write.
+    - municipalities (int): Number of municipalities.
+    - productivity_years (list): Years with a productivity column.
+    - seed (int): Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed + 1)
+    df = pd.DataFrame({
+        'codigo_ibge': 4100000 + np.arange(municipalities),
+        'name': [f'Municipality {number}' for number in range(municipalities)],
+        'mesoregion': rng.choice(MESOREGIONS, municipalities),
+    })
+    trend = np.arange(len(productivity_years)) * 40
+    for year, offset in zip(productivity_years, trend):
+        # The year columns of the real file start with a space
+        df[f' {year}'] = (rng.normal(2800, 500, municipalities) + offset).round().astype(int)
+    df.to_csv(file_path, index=False)
+
+
+def generate_dataset(input_folder, stations=REAL_STATIONS, years=REAL_YEARS, municipalities=None,
+                     productivity_years=PRODUCTIVITY_YEARS, seed=0):
+    """
+    Write a synthetic dataset shaped like the Kaggle dataset in an input folder.
+
+    Args:
+    - input_folder (str): The directory where the CSV files are written.
+    - stations (int): Number of stations.
+    - years (tuple): First and last year of the daily data.
+    - municipalities (int): Number of municipalities. If None, each station is a municipality.
+    - productivity_years (list): Years with a productivity column.
+    - seed (int): Seed of the random generator.
+
+    Returns:
+    - int: Number of rows of the climate CSV file.
+    """
+    os.makedirs(input_folder, exist_ok=True)
+    rows = generate_climate_csv(os.path.join(input_folder, 'agroclimatology.csv'), stations, years,
+                                municipalities, seed)
+    generate_productivity_csv(os.path.join(input_folder, 'productividade_soja.csv'),
+                              municipalities or stations, productivity_years, seed)
+    return rows
+
+
+def benchmark_pipeline(input_folder, output_folder, engine='pandas', **options):
+    """
+    Run extract_subfile without cache and return the measures of its stages.
+
+    Args:
+    - input_folder (str): The directory containing the dataset.
+    - output_folder (str): The directory where the processed data is written.
+    - engine (str): Engine processing the data in memory.
+    - **options: Other options of extract_subfile, e.g. workers.
+
+    Returns:
+    - pd.DataFrame: The processed DataFrame.
+    - pd.DataFrame: The productivity DataFrame.
+    - dict: The run report of extract_subfile.
+    """
+    shutil.rmtree(output_folder, ignore_errors=True)
+    os.makedirs(output_folder)
+    df, df_soja, _ = extract_subfile(input_folder, output_folder, use_cache=False, incremental=False,
+                                     engine=engine, **options)
+    with open(os.path.join(output_folder, RUN_REPORT_FILE), "r", encoding="utf-8") as file:
+        return df, df_soja, json.load(file)
+
+
+def benchmark_dashboard(df, df_soja, model_plot=True):
+    """
+    Time the helpers of dash_tot on a processed DataFrame.
+
+    The helpers are called with the same arguments as in the dashboard
+    callbacks, their printed output is discarded.
+
+    Args:
+    - df (pd.DataFrame): The processed DataFrame.
+    - df_soja (pd.DataFrame): The productivity DataFrame.
+    - model_plot (bool): Whether to time also update_lineplot2, which fits
+      one model per municipality and is by far the slowest helper.
+
+    Returns:
+    - dict: The run report of the helpers.
+    """
+    report = new_run_report()
+    variables = list(CLIMATE_VARIABLES)
+    variable_details = {variable: [variable, ''] for variable in variables}
+    year = int(df['year'].min()) + 1
+    selected = {'year': year, 'month': 3, 'day': 7, 'season': 'Winter', 'var': 'TS'}
+
+    def measure(name, function, *args):
+        with measure_stage(report, name, rows_in=len(df)), open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            return function(*args)
+
+    compact_df = measure('compact_frame', compact_frame, df)
+    municipalities = measure('build_municipality_dim', build_municipality_dim, df_soja)
+    cube = measure('build_aggregate_cube', build_aggregate_cube, df, variables)
+    productivity_totals = compute_productivity_totals(df_soja, df_soja.columns[3:])
+    colormap = measure('generate_colormaps', dash_tot.generate_colormaps, compact_df, variables)
+    regions = measure('divide_dataset', dash_tot.divide_dataset, compact_df)
+    regions_year = [region.groupby('year') for region in regions]
+    measure('update_map', dash_tot.update_map, compact_df, municipalities, selected['year'], selected['month'],
+            selected['day'], selected['var'], variable_details, colormap)
+    date_index = measure('build_date_index', dash_tot.build_date_index, compact_df)
+    measure('update_map_indexed', dash_tot.update_map, compact_df, municipalities, selected['year'],
+            selected['month'], selected['day'], selected['var'], variable_details, colormap, None, None, date_index)
+    stations = measure('station_layer', dash_tot.station_layer, compact_df, municipalities)
+    measure('update_map_data', dash_tot.update_map_data, compact_df, municipalities, stations, selected['year'],
+            selected['month'], selected['day'], selected['var'], colormap, None, None, date_index)
+    measure('update_histogram', dash_tot.update_histogram, selected['year'], selected['season'], selected['var'],
+            variable_details, *regions_year)
+    measure('update_lineplot', dash_tot.update_lineplot, selected['var'], variable_details, cube,
+            productivity_totals)
+    measure('productivity_to_df', dash_tot.productivity_to_df, compact_df, municipalities)
+    if model_plot:
+        measure('update_lineplot2', dash_tot.update_lineplot2, compact_df, municipalities, *regions)
+    return finish_run_report(report)
+
+
+def run_benchmark(work_folder, scales=SCALES, stations=REAL_STATIONS, years=REAL_YEARS, engines=None,
+                  dashboard=True, model_plot=True, output_file=BENCHMARK_FILE, workers=None):
+    """
+    Measure the pipeline and the dashboard helpers on synthetic datasets of growing size.
+
+    For each scale a dataset with scale times the stations is generated,
+    processed with each engine and, optionally, used to time the dashboard
+    helpers. The measures are written as JSON, one record per stage.
+
+    With workers, the pandas engine is run also with each number of worker
+    processes, and its speedup is the total wall time of the serial pandas
+    run divided by the one of the parallel run.
+
+    Args:
+    - work_folder (str): The directory where the datasets are generated.
+    - scales (list): Multiples of the number of stations to measure.
+    - stations (int): Number of stations at scale 1.
+    - years (tuple): First and last year of the daily data.
+    - engines (list): Engines to compare. If None, every available engine.
+    - dashboard (bool): Whether to time the dashboard helpers.
+    - model_plot (bool): Whether to time also update_lineplot2.
+    - output_file (str): Path of the JSON file with the results.
+    - workers (list): Numbers of worker processes to compare with the serial pandas run. If None, no parallel run.
+
+    Returns:
+    - list: The records of the results.
+    """
+    if engines is None:
+        engines = [engine for engine in ENGINES if engine != 'polars' or pl is not None]
+    results = []
+    for scale in scales:
+        input_folder = os.path.join(work_folder, f'scale_{scale}', 'input')
+        start = time.perf_counter()
+        rows = generate_dataset(input_folder, stations * scale, years)
+        print(f'Scale {scale}: {rows} rows generated in {time.perf_counter() - start:.1f} s.')
+        # The serial pandas run is the reference of the parallel ones
+        runs = [(engine, 1) for engine in engines]
+        if workers:
+            if 'pandas' not in engines:
+                runs.append(('pandas', 1))
+            runs += [('pandas', count) for count in workers if count > 1]
+        serial_wall = None
+        for engine, count in runs:
+            output_folder = os.path.join(work_folder, f'scale_{scale}', f'output_{engine}_{count}')
+            df, df_soja, run_report = benchmark_pipeline(input_folder, output_folder, engine, workers=count)
+            reports = {'pipeline': run_report}
+            if dashboard and (engine, count) == runs[0]:
+                reports['dashboard'] = benchmark_dashboard(df, df_soja, model_plot)
+            if engine == 'pandas' and count == 1:
+                serial_wall = run_report['total_wall_s']
+            elif engine == 'pandas':
+                print(f'Scale {scale}: speedup with {count} workers {serial_wall / run_report["total_wall_s"]:.2f} x '
+                      f'({serial_wall:.2f} s serial, {run_report["total_wall_s"]:.2f} s parallel).')
+            for suite, report in reports.items():
+                for stage, measures in report['stages'].items():
+                    results.append({'scale': scale, 'rows': rows, 'engine': engine, 'workers': count, 'suite': suite,
+                                    'stage': stage, **measures})
+                results.append({'scale': scale, 'rows': rows, 'engine': engine, 'workers': count, 'suite': suite,
+                                'stage': 'total', 'wall_s': report['total_wall_s'], 'cpu_s': report['total_cpu_s']})
+    output = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                    'processors': os.cpu_count(), 'pandas': pd.__version__},
+        'stations': stations,
+        'years': list(years),
+        'results': results,
+    }
+    with open(output_file, "w", encoding="utf-8") as file:
+        json.dump(output, file, indent=2)
+    print(pd.DataFrame(results).pivot_table(index=['suite', 'stage'], columns=['scale', 'engine', 'workers'],
+                                            values='wall_s', sort=False).round(3))
+    print(f'Results written to {output_file}.')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline and the dashboard on synthetic data.')
+    parser.add_argument('work_folder', help='Directory where the synthetic datasets are generated.')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help='Multiples of the real size.')
+    parser.add_argument('--stations', type=int, default=REAL_STATIONS, help='Number of stations at scale 1.')
+    parser.add_argument('--years', type=int, nargs=2, default=REAL_YEARS, help='First and last year of the data.')
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, help='Engines to compare (default: all available).')
+    parser.add_argument('--no-dashboard', action='store_true', help='Do not time the dashboard helpers.')
+    parser.add_argument('--no-model-plot', action='store_true', help='Do not time update_lineplot2.')
+    parser.add_argument('--output', default=BENCHMARK_FILE, help='JSON file with the results.')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        help='Numbers of worker processes to compare with the serial pandas run.')
+    args = parser.parse_args()
+    run_benchmark(args.work_folder, args.scales, args.stations, tuple(args.years), args.engines,
+                  not args.no_dashboard, not args.no_model_plot, args.output,
+                  args.workers)
+
+
+if __name__ == "__main__":
+    main()
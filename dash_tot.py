@@ -1,12 +1,14 @@
 import dash
 from dash import dcc, html
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 import pandas as pd
 import folium
 from branca.colormap import LinearColormap
 from collections import defaultdict
 import plotly.express as px
 import io
+import json
+import time
 import base64
 import plotly.graph_objects as go
 
@@ -22,39 +24,117 @@ from statsmodels.tools.sm_exceptions import ConvergenceWarning
 
 from plotly.subplots import make_subplots
 
+from elaborate_2 import build_municipality_dim, lookup_municipalities, build_aggregate_cube, compute_productivity_totals
+from map_cache import MAP_CACHE_MB, new_lru_cache, lru_get_or_compute, lru_stats
+
+# Bump this whenever the rendering of the maps changes (e.g. create_map or the legend),
+# so that the maps cached on disk by an older version are rendered again.
+MAP_RENDER_VERSION = 1
+
+# Colors of the colormaps, from the lowest to the highest value
+COLORMAP_COLORS = ['purple', 'blue', 'yellow', 'orange', 'red']
+
+# Hexadecimal digits of each byte, to format the colors of many values at once
+HEX_BYTES = np.array([f'{value:02x}' for value in range(256)], dtype=object)
+
+
 # Map functions
-def generate_colormaps(df, variables):
+def generate_colormaps(df, variables, scale='linear'):
     """
     Generate LinearColormap for numeric columns in the DataFrame.
 
+    With the 'quantile' scale, the colors are placed at the quartiles of the
+    column instead of at regular intervals, so that each color covers the
+    same number of measurements.
+
     Args:
     - df (pd.DataFrame): The DataFrame.
     - variables (list): List of column names.
+    - scale (str): 'linear' or 'quantile'.
 
     Returns:
     - dict: A dictionary containing LinearColormap objects for each numeric column.
     """
     colormaps = {}
     for column in df.columns:
-        if column in variables and df[column].dtype in [int, float]:
-            # Assuming numeric columns should have a LinearColormap
-            colormaps[column] = LinearColormap(['purple', 'blue', 'yellow', 'orange', 'red'], vmin=df[column].min(), vmax=df[column].max())
+        if column in variables and pd.api.types.is_numeric_dtype(df[column]):
+            if scale == 'quantile':
+                index = df[column].quantile(np.linspace(0, 1, len(COLORMAP_COLORS))).astype(float).tolist()
+                colormaps[column] = LinearColormap(COLORMAP_COLORS, index=index, vmin=index[0], vmax=index[-1])
+            else:
+                # Assuming numeric columns should have a LinearColormap
+                colormaps[column] = LinearColormap(COLORMAP_COLORS, vmin=df[column].min(), vmax=df[column].max())
     return colormaps
 
-def find_normalized_productivity(sub_data_unique_coord, df_soja, selected_year):
-    # Check if 'name_ibge' column exists in sub_data_unique_coord and 'name' column exists in df_soja
-    if 'name_ibge' in sub_data_unique_coord.columns and 'name' in df_soja.columns:
-        # Merge the dataframes based on the condition name_ibge == name
-        merged_df = sub_data_unique_coord.merge(df_soja[['name', selected_year]], left_on='name_ibge', right_on='name', how='left')
 
-        # Rename the selected_year column to a unique name (avoid name conflicts)
-        merged_df = merged_df.rename(columns={selected_year: 'productivity'})
+def colors_of_values(values, colormap, missing_color='green'):
+    """
+    Map an array of values to the colors of a colormap in one vectorized pass.
+
+    Each value gives the same "#RRGGBBAA" string as colormap(value) called
+    with the NumPy scalar of the array. colormap(value) computes in the
+    precision NumPy gives to the value and the stops: the stops of the
+    quantile scale are Python floats, which take the precision of the value,
+    those of the linear scale are NumPy scalars of the type of the column.
+    The same promotion is applied here, step by step.
 
-        # Return the updated DataFrame
-        return merged_df
+    Args:
+    - values (array-like): The values.
+    - colormap: LinearColormap of the variable.
+    - missing_color (str): Color of the missing values.
+
+    Returns:
+    - np.ndarray: The color of each value.
+    """
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.floating):
+        values = values.astype(float)
+    index = np.asarray(colormap.index)
+    if not np.issubdtype(index.dtype, np.floating):
+        index = index.astype(float)
+    # Python floats take the type of the value, NumPy scalars are promoted with it
+    python_stops = all(isinstance(stop, (int, float)) and not isinstance(stop, np.generic) for stop in colormap.index)
+    dtype = values.dtype if python_stops else np.result_type(values.dtype, index.dtype)
+    values = values.astype(dtype)
+    stops = index.astype(dtype)
+    palette = np.asarray(colormap.colors, dtype=float)
+
+    # Stops around each value, the values outside the colormap take the color of its ends
+    right = np.clip(np.searchsorted(stops, values, side='left'), 1, len(index) - 1)
+    left = right - 1
+    # The width of an interval is computed in the type of the stops, equal stops take the color of the right one
+    width = index[right] - index[left]
+    interpolated = (values > stops[0]) & (values < stops[-1]) & (width > 0)
+    rgba = palette[np.where(values <= stops[0], 0, np.where(values >= stops[-1], len(index) - 1, right))]
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        weight = ((values - stops[left]) / width.astype(dtype))[interpolated][:, None]
+        mixed = (1 - weight) * palette[left[interpolated]].astype(dtype) + weight * palette[right[interpolated]].astype(dtype)
+    byte_scale = np.array(255.9999)
+    channels = (rgba * byte_scale).astype(int)
+    channels[interpolated] = (mixed * byte_scale.astype(dtype)).astype(int)
+
+    # In single precision a weight can round beyond 1, colormap(value) then writes the channel 256
+    hex_bytes = HEX_BYTES if channels.max(initial=0) < len(HEX_BYTES) \
+        else np.array([f'{value:02x}' for value in range(channels.max() + 1)], dtype=object)
+    colors = '#' + hex_bytes[channels[:, 0]] + hex_bytes[channels[:, 1]] + hex_bytes[channels[:, 2]] + hex_bytes[channels[:, 3]]
+    colors[np.isnan(values)] = missing_color
+    return colors
+
+
+def find_normalized_productivity(sub_data_unique_coord, municipalities, selected_year):
+    # The productivity years are the names of the columns of the municipality table
+    selected_year = str(selected_year)
+    # Check if 'codigo_ibge' column exists in sub_data_unique_coord and the year exists in the municipality table
+    if 'codigo_ibge' in sub_data_unique_coord.columns and selected_year in municipalities.columns:
+        codes = sub_data_unique_coord['codigo_ibge']
+        # Look up the name and the productivity of each municipality by its code
+        return sub_data_unique_coord.assign(
+            name_ibge=lookup_municipalities(codes, municipalities, 'name'),
+            productivity=lookup_municipalities(codes, municipalities, selected_year),
+        )
     else:
-        # If 'name_ibge' or 'name' columns don't exist in respective DataFrames
-        print("'name_ibge' column not found in sub_data_unique_coord or 'name' column not found in df_soja.")
+        # If 'codigo_ibge' or the year don't exist in respective DataFrames
+        print(f"'codigo_ibge' column not found in sub_data_unique_coord or year {selected_year} not found in the municipality table.")
         return sub_data_unique_coord  # Return the original DataFrame
 
 
@@ -138,48 +218,318 @@ def create_map(df, color_dict, colormap, selected_var, variable_details):
         return None
     
 
-def update_map(df, df_soja, selected_year, selected_month, selected_day, selected_var, variable_details, colormap):
+def build_date_index(df):
+    """
+    Index the rows of the DataFrame by date, once for all the selections of the map.
+
+    The positions of the rows are sorted by date, keeping their order within
+    a day, and each date points to its range of positions. The rows of a day
+    are then taken without scanning nor modifying the DataFrame.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame with 'year', 'month' and 'day' columns.
+
+    Returns:
+    - dict: 'order', the positions of the rows sorted by date, and 'offsets',
+      the (start, stop) range in 'order' of each date as an integer YYYYMMDD.
+    """
+    dates = (df['year'].to_numpy(dtype=np.int64) * 10000 + df['month'].to_numpy(dtype=np.int64) * 100 +
+             df['day'].to_numpy(dtype=np.int64))
+    order = np.argsort(dates, kind='stable').astype(np.int32 if len(df) < 2**31 else np.int64)
+    sorted_dates, starts = np.unique(dates[order], return_index=True)
+    stops = np.append(starts[1:], len(df))
+    return {'order': order, 'offsets': dict(zip(sorted_dates.tolist(), zip(starts.tolist(), stops.tolist())))}
+
+
+def day_rows(df, date_index, selected_year, selected_month, selected_day):
+    """
+    Select the rows of a day.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame with geographical data.
+    - date_index (dict): The index of the dates, as returned by build_date_index. If None, the rows are
+      selected by scanning the date columns.
+    - selected_year (int): Selected year.
+    - selected_month (int): Selected month.
+    - selected_day (int): Selected day.
+
+    Returns:
+    - pd.DataFrame: The rows of the day, in the order of the DataFrame.
+    """
+    if date_index is None:
+        return df[
+            (df['year'] == int(selected_year)) &
+            (df['month'] == int(selected_month)) &
+            (df['day'] == int(selected_day))
+        ]
+    start, stop = date_index['offsets'].get(int(selected_year) * 10000 + int(selected_month) * 100 + int(selected_day),
+                                            (0, 0))
+    return df.take(date_index['order'][start:stop])
+
+
+def map_markers(df, municipalities, selected_year, selected_month, selected_day, selected_var, colormap,
+                date_index=None):
+    """
+    Compute the markers of the map of a day: position, size and color of each municipality.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame with geographical data.
+    - municipalities (pd.DataFrame): The municipality table, indexed by 'codigo_ibge'.
+    - selected_year (int): Selected year.
+    - selected_month (int): Selected month.
+    - selected_day (int): Selected day.
+    - selected_var (str): Selected variable for color representation.
+    - colormap: Dictionary of the LinearColormap of each variable.
+    - date_index (dict): The index of the dates, as returned by build_date_index.
+
+    Returns:
+    - pd.DataFrame: One row per municipality with its coordinates, name, normalized productivity
+      and value of the variable.
+    - dict: Color of each (latitude, longitude) pair.
+    """
+    filtered_data = day_rows(df, date_index, selected_year, selected_month, selected_day)
+
+    color_dict_filtered = defaultdict(str)
+    if not filtered_data.empty:
+        # The missing values (masked fill values) keep the default color of the markers
+        colored = filtered_data[filtered_data[selected_var].notna()]
+        colors = colors_of_values(colored[selected_var].to_numpy(), colormap[selected_var])
+        color_dict_filtered.update(zip(zip(colored['latitude'].tolist(), colored['longitude'].tolist()), colors))
+
+        # The value of the variable is kept for the data of the station map
+        subdata_unique_coord = filtered_data[['codigo_ibge', 'latitude', 'longitude', selected_var]].drop_duplicates(
+            ['codigo_ibge', 'latitude', 'longitude'])
+        subdata_unique_coord = find_normalized_productivity(subdata_unique_coord, municipalities, selected_year)
+        subdata_unique_coord['productivity'] = normalize_values(subdata_unique_coord['productivity'], 5, 15)   # now the column has normalized values
+    else:
+        subdata_unique_coord = pd.DataFrame(columns=['latitude', 'longitude'])
+
+    return subdata_unique_coord, color_dict_filtered
+
+
+def markers_size(markers):
+    """
+    Estimate the memory used by the markers of a map, in bytes.
+
+    Args:
+    - markers (tuple): The markers, as returned by map_markers.
+
+    Returns:
+    - int: Estimated size in bytes.
+    """
+    subdata_unique_coord, color_dict = markers
+    return int(subdata_unique_coord.memory_usage(deep=True).sum()) + 200 * len(color_dict)
+
+
+def update_map(df, municipalities, selected_year, selected_month, selected_day, selected_var, variable_details, colormap,
+               map_cache=None, markers_cache=None, date_index=None):
     """
     Update the Folium map based on selected options.
 
+    The rendered maps and their markers are kept in LRU caches keyed by
+    (year, month, day, variable), so going back to a recent date does not
+    build the map again.
+
     Args:
     - df (pd.DataFrame): The DataFrame with geographical data.
-    - selected_year (str): Selected year.
-    - selected_month (str): Selected month.
-    - selected_day (str): Selected day.
+    - municipalities (pd.DataFrame): The municipality table, indexed by 'codigo_ibge'.
+    - selected_year (int): Selected year.
+    - selected_month (int): Selected month.
+    - selected_day (int): Selected day.
     - selected_var (str): Selected variable for color representation.
     - variable_details (dict): Details about the variables.
-    - colormap: LinearColormap object representing the colors for the selected variable.
+    - colormap: Dictionary of the LinearColormap of each variable.
+    - map_cache (dict): Cache of the rendered maps (see map_cache). If None, the map is always rendered.
+    - markers_cache (dict): Cache of the markers of the maps. If None, the markers are always computed.
+    - date_index (dict): The index of the dates, as returned by build_date_index.
 
     Returns:
     - str: HTML representation of the updated Folium map.
     """
-    df['year'] = df['year'].astype(str)
-    df['month'] = df['month'].astype(str)
-    df['day'] = df['day'].astype(str)
+    key = (int(selected_year), int(selected_month), int(selected_day), selected_var)
 
-    filtered_data = df[
-        (df['year'] == selected_year) &
-        (df['month'] == selected_month) &
-        (df['day'] == selected_day)
-    ]
+    def render():
+        subdata_unique_coord, color_dict_filtered = lru_get_or_compute(
+            markers_cache, key,
+            lambda: map_markers(df, municipalities, selected_year, selected_month, selected_day, selected_var, colormap,
+                                date_index),
+            markers_size)
+        return create_map(subdata_unique_coord, color_dict_filtered, colormap[selected_var], selected_var, variable_details)
 
-    color_dict_filtered = defaultdict(str)
-    if not filtered_data.empty:
-        for index, row in filtered_data.iterrows():
-            color = colormap[selected_var](row[selected_var])
-            color_dict_filtered[(row['latitude'], row['longitude'])] = color
+    return lru_get_or_compute(map_cache, key, render)
 
-        subdata_unique_coord = filtered_data[['name_ibge', 'latitude', 'longitude']].drop_duplicates()
-        subdata_unique_coord = find_normalized_productivity(subdata_unique_coord, df_soja, selected_year)
-        subdata_unique_coord['productivity'] = normalize_values(subdata_unique_coord['productivity'], 5, 15)   # now the column has normalized values
-        map_html = create_map(subdata_unique_coord, color_dict_filtered, colormap[selected_var], selected_var, variable_details)
+def station_layer(df, municipalities):
+    """
+    Build the table of the stations shown on the map, once for all the dates.
 
-    else:
-        empty_data = pd.DataFrame(columns=['latitude', 'longitude'])
-        map_html = create_map(empty_data, color_dict_filtered, colormap[selected_var], selected_var, variable_details)
+    Args:
+    - df (pd.DataFrame): The DataFrame with geographical data.
+    - municipalities (pd.DataFrame): The municipality table, indexed by 'codigo_ibge'.
+
+    Returns:
+    - pd.DataFrame: One row per station with its code, coordinates and municipality name,
+      indexed by (latitude, longitude).
+    """
+    stations = df[['codigo_ibge', 'latitude', 'longitude']].drop_duplicates(['latitude', 'longitude'])
+    stations = stations.sort_values(['latitude', 'longitude'])
+    stations['name_ibge'] = lookup_municipalities(stations['codigo_ibge'], municipalities, 'name')
+    return stations.set_index(['latitude', 'longitude'], drop=False)
 
-    return map_html
+
+def colormap_scale(colormap):
+    """
+    Convert a LinearColormap to a Plotly colorscale.
+
+    Args:
+    - colormap: LinearColormap of a variable.
+
+    Returns:
+    - list: The colorscale, pairs of position between 0 and 1 and color.
+    """
+    span = float(colormap.vmax - colormap.vmin) or 1.0
+    return [[float(stop - colormap.vmin) / span, f'rgb({int(r * 255)},{int(g * 255)},{int(b * 255)})']
+            for stop, (r, g, b, _) in zip(colormap.index, colormap.colors)]
+
+
+def create_station_map(stations):
+    """
+    Create the map figure with the layer of the stations, without the values of a date.
+
+    The figure is created once: the colors and sizes of the markers are
+    applied in the browser from the data sent by update_map_data.
+
+    Args:
+    - stations (pd.DataFrame): The stations, as returned by station_layer.
+
+    Returns:
+    - go.Figure: The map figure.
+    """
+    fig = go.Figure()
+    fig.add_trace(go.Scattermap(
+        lat=stations['latitude'].astype(float),
+        lon=stations['longitude'].astype(float),
+        mode='markers',
+        text=stations['name_ibge'].fillna('').astype(str),
+        marker=dict(size=0, color='green', opacity=0.6),
+        hovertemplate='Name municìpios: %{text}<br>%{customdata}<extra></extra>',
+        showlegend=False,
+    ))
+    # Empty trace showing the colorbar of the selected variable
+    fig.add_trace(go.Scattermap(
+        lat=[None], lon=[None], mode='markers', hoverinfo='skip', showlegend=False,
+        marker=dict(colorscale=[[0, 'white'], [1, 'white']], cmin=0, cmax=1, showscale=True,
+                    colorbar=dict(title=dict(text=''), thickness=15)),
+    ))
+    fig.update_layout(
+        map=dict(style='open-street-map', zoom=5.8,
+                 center=dict(lat=float(stations['latitude'].mean()), lon=float(stations['longitude'].mean()))),
+        margin=dict(l=0, r=0, t=0, b=0),
+        height=500,
+        annotations=[dict(text='Radius is proportional to Productivity.', x=0.01, y=0.02, xref='paper', yref='paper',
+                          showarrow=False, bgcolor='white', bordercolor='grey', borderwidth=1)],
+    )
+    return fig
+
+
+def map_data(df, municipalities, stations, selected_year, selected_month, selected_day, selected_var, colormap,
+             markers_cache=None, date_index=None):
+    """
+    Compute the values of the markers of the station map for a day.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame with geographical data.
+    - municipalities (pd.DataFrame): The municipality table, indexed by 'codigo_ibge'.
+    - stations (pd.DataFrame): The stations, as returned by station_layer.
+    - selected_year (int): Selected year.
+    - selected_month (int): Selected month.
+    - selected_day (int): Selected day.
+    - selected_var (str): Selected variable for color representation.
+    - colormap: Dictionary of the LinearColormap of each variable.
+    - markers_cache (dict): Cache of the markers of the maps. If None, the markers are always computed.
+    - date_index (dict): The index of the dates, as returned by build_date_index.
+
+    Returns:
+    - str: JSON with the color, diameter and value of each station, in the order of the stations,
+      and the colorbar of the variable.
+    """
+    key = (int(selected_year), int(selected_month), int(selected_day), selected_var)
+    subdata_unique_coord, color_dict = lru_get_or_compute(
+        markers_cache, key,
+        lambda: map_markers(df, municipalities, selected_year, selected_month, selected_day, selected_var, colormap,
+                            date_index),
+        markers_size)
+    # Stations without data on the day are hidden with a null size
+    size = np.zeros(len(stations))
+    color = np.full(len(stations), 'green', dtype=object)
+    values = np.full(len(stations), np.nan)
+    if not subdata_unique_coord.empty:
+        positions = stations.index.get_indexer(
+            pd.MultiIndex.from_arrays([subdata_unique_coord['latitude'], subdata_unique_coord['longitude']]))
+        found = positions >= 0
+        # The radius of the Folium markers is half the diameter of the Plotly ones
+        size[positions[found]] = 2 * subdata_unique_coord['productivity'].to_numpy(dtype=float)[found]
+        color[positions[found]] = [color_dict.get(pair, 'green') for pair in
+                                   stations.index[positions[found]]]
+        values[positions[found]] = subdata_unique_coord[selected_var].to_numpy(dtype=float)[found]
+    selected_colormap = colormap[selected_var]
+    return json.dumps({
+        'color': [str(value)[:7] for value in color],
+        'size': np.round(np.nan_to_num(size), 1).tolist(),
+        'value': [f'{selected_var}: {value:.2f}' if value == value else '' for value in values],
+        'colorscale': colormap_scale(selected_colormap),
+        'cmin': float(selected_colormap.vmin),
+        'cmax': float(selected_colormap.vmax),
+        'caption': selected_var,
+    }, separators=(',', ':'))
+
+
+def update_map_data(df, municipalities, stations, selected_year, selected_month, selected_day, selected_var, colormap,
+                    map_cache=None, markers_cache=None, date_index=None):
+    """
+    Update the values of the station map based on selected options.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame with geographical data.
+    - municipalities (pd.DataFrame): The municipality table, indexed by 'codigo_ibge'.
+    - stations (pd.DataFrame): The stations, as returned by station_layer.
+    - selected_year (int): Selected year.
+    - selected_month (int): Selected month.
+    - selected_day (int): Selected day.
+    - selected_var (str): Selected variable for color representation.
+    - colormap: Dictionary of the LinearColormap of each variable.
+    - map_cache (dict): Cache of the map data (see map_cache). If None, the data is always computed.
+    - markers_cache (dict): Cache of the markers of the maps. If None, the markers are always computed.
+    - date_index (dict): The index of the dates, as returned by build_date_index.
+
+    Returns:
+    - str: JSON with the values of the markers, applied to the map in the browser.
+    """
+    key = ('data', int(selected_year), int(selected_month), int(selected_day), selected_var)
+    return lru_get_or_compute(map_cache, key, lambda: map_data(
+        df, municipalities, stations, selected_year, selected_month, selected_day, selected_var, colormap,
+        markers_cache, date_index))
+
+
+# Applies the data of update_map_data to the station map, in the browser
+APPLY_MAP_DATA = """
+function(data, figure) {
+    if (!data || !figure) {
+        return window.dash_clientside.no_update;
+    }
+    const values = JSON.parse(data);
+    const stations = Object.assign({}, figure.data[0], {
+        customdata: values.value,
+        marker: Object.assign({}, figure.data[0].marker, {color: values.color, size: values.size}),
+    });
+    const colorbar = Object.assign({}, figure.data[1], {
+        marker: Object.assign({}, figure.data[1].marker, {
+            colorscale: values.colorscale, cmin: values.cmin, cmax: values.cmax,
+            colorbar: Object.assign({}, figure.data[1].marker.colorbar, {title: {text: values.caption}}),
+        }),
+    });
+    return Object.assign({}, figure, {data: [stations, colorbar].concat(figure.data.slice(2))});
+}
+"""
 
 # Histograms functions
 def divide_dataset(df):
@@ -273,8 +623,10 @@ def update_histogram(selected_year, selected_season, selected_var, variable_deta
         color = 'blue' if direction == 'North' else 'orange'
 
         num_bins = 100
-        bin_width = (max(direction_var_season) - min(direction_var_season)) / num_bins
-        bins = [i * bin_width + min(direction_var_season) for i in range(num_bins + 1)]
+        # Missing values (NaN) are skipped by the Series min and max
+        var_min, var_max = direction_var_season.min(), direction_var_season.max()
+        bin_width = (var_max - var_min) / num_bins
+        bins = [i * bin_width + var_min for i in range(num_bins + 1)]
 
         fig.add_trace(
             go.Histogram(
@@ -282,7 +634,7 @@ def update_histogram(selected_year, selected_season, selected_var, variable_deta
                 name=direction,
                 marker_color=color,
                 opacity=0.4,
-                xbins=dict(start=min(direction_var_season), end=max(direction_var_season), size=bin_width)
+                xbins=dict(start=var_min, end=var_max, size=bin_width)
             )
         )
 
@@ -292,8 +644,10 @@ def update_histogram(selected_year, selected_season, selected_var, variable_deta
         color = 'green' if direction == 'East' else 'red'
 
         num_bins = 100
-        bin_width = (max(direction_var_season) - min(direction_var_season)) / num_bins
-        bins = [i * bin_width + min(direction_var_season) for i in range(num_bins + 1)]
+        # Missing values (NaN) are skipped by the Series min and max
+        var_min, var_max = direction_var_season.min(), direction_var_season.max()
+        bin_width = (var_max - var_min) / num_bins
+        bins = [i * bin_width + var_min for i in range(num_bins + 1)]
 
         fig.add_trace(
             go.Histogram(
@@ -301,7 +655,7 @@ def update_histogram(selected_year, selected_season, selected_var, variable_deta
                 name=direction,
                 marker_color=color,
                 opacity=0.4,
-                xbins=dict(start=min(direction_var_season), end=max(direction_var_season), size=bin_width)
+                xbins=dict(start=var_min, end=var_max, size=bin_width)
             )
         )
 
@@ -312,16 +666,25 @@ def update_histogram(selected_year, selected_season, selected_var, variable_deta
 
 
 
-def update_lineplot(selected_var, variable_details, df, df_soja):
+def update_lineplot(selected_var, variable_details, cube, productivity_totals):
+    """
+    Plot the mean of a variable by season for each year, read from the aggregate cube.
 
-    # Calculate the sum for columns from the third position
-    year_productivity = {col: df_soja[col].sum() for col in df_soja.columns[3:]}
+    Args:
+    - selected_var (str): Selected variable.
+    - variable_details (dict): Details about the variables.
+    - cube (pd.DataFrame): The aggregate cube (see elaborate_2.build_aggregate_cube).
+    - productivity_totals (dict): Total productivity of each year.
 
-    
-    mean_var = df.groupby(['year', 'season'])[selected_var].mean().reset_index()
+    Returns:
+    - plotly.graph_objects.Figure: The line plot.
+    """
+    # The mean of each (year, season) is the sum of the values over their count
+    totals = cube.groupby(['year', 'season'], observed=True)[[f'{selected_var}_sum', f'{selected_var}_count']].sum()
+    mean_var = (totals[f'{selected_var}_sum'] / totals[f'{selected_var}_count']).rename(selected_var).reset_index()
     
     # Normalize productivity values between 1 and 3
-    normalized_productivity = normalize_values(year_productivity, new_min=0.1, new_max=1)
+    normalized_productivity = normalize_values(productivity_totals, new_min=0.1, new_max=1)
 
     # Aggiunta della colonna 'normalized_productivity' al DataFrame 'mean_var'
     mean_var['normalized_productivity'] = mean_var['year'].map(normalized_productivity)
@@ -457,35 +820,28 @@ def update_lineplot(selected_var, variable_details, df, df_soja):
 
 
 
-def productivity_to_df(df, df_soja):
-    # DROPPA COLONNE PRIMA DI FARE CIO'
-    #print(df.columns)
-    subdata_unique_name_year = df[['name_ibge', 'year', 'latitude', 'longitude']].drop_duplicates()
-    # print(f'subdata_unique_name_year = ', subdata_unique_name_year)
-    #print(df_soja)
-    # Merging dataframes
-    subdata_unique_name_year = pd.merge(subdata_unique_name_year, df_soja, left_on='name_ibge', right_on='name', how='left')
-     # for row in merged_df.itertuples():
-    #     if str(row.year) in merged_df.columns:
-    #         df.at[row.Index, 'productivity'] = merged_df.at[row.Index, str(row.year)]
+def productivity_to_df(df, municipalities):
+    """
+    Build the productivity of each municipality in each year of the DataFrame.
 
-    
-    # Filter out the columns from 'df_soja' that contain the numeric values
-    year_columns = df_soja.columns[3:]
-    # print(year_columns)
-    # Create an empty list to store productivity values
-    productivity_data = pd.DataFrame(columns = ['name_ibge', 'latitude', 'longitude', 'year','productivity'])
-    # print(f' COLUMNS of subdata_unique_name_year = ', subdata_unique_name_year.columns)
-    # Iterate through the merged dataframe and check for matches
-    for index, row in subdata_unique_name_year.iterrows():
-        for col in year_columns:
-            # print(row['year'], row[col])
-            # print(type(row['year']), type(row[col]))
-            if row['year'] == col:
-                productivity_data.loc[index] = [row['name_ibge'], row['latitude'], row['longitude'], row['year'], row[col]]
-
-    # Assign the obtained productivity values to the 'productivity' column in 'df'
-    #subdata_unique_name_year['productivity'] = productivity_values
+    Args:
+    - df (pd.DataFrame): The DataFrame with geographical data.
+    - municipalities (pd.DataFrame): The municipality table, indexed by 'codigo_ibge'.
+
+    Returns:
+    - pd.DataFrame: Columns 'name_ibge', 'latitude', 'longitude', 'year' and 'productivity',
+      only for the years with a productivity column.
+    """
+    subdata_unique_code_year = df[['codigo_ibge', 'year', 'latitude', 'longitude']].drop_duplicates()
+
+    # The columns after 'name' and 'mesoregion' contain the productivity of each year
+    year_columns = municipalities.columns[2:]
+    # One row for each (codigo_ibge, year) pair, joined on the integer keys
+    productivity_long = municipalities[year_columns].rename(columns=int).reset_index().melt(
+        id_vars='codigo_ibge', var_name='year', value_name='productivity')
+    productivity_data = subdata_unique_code_year.merge(productivity_long, on=['codigo_ibge', 'year'], how='inner')
+    productivity_data['name_ibge'] = lookup_municipalities(productivity_data['codigo_ibge'], municipalities, 'name')
+    productivity_data = productivity_data[['name_ibge', 'latitude', 'longitude', 'year', 'productivity']]
 
     print(f'prod-val: {productivity_data}')
     return productivity_data
@@ -538,12 +894,12 @@ def Remove_Outlier_Indices(df):
 #     return scatter_fig
 
 # NON è UN GRAFICO DINAMICO!Togli da dinamicità
-def update_lineplot2(df, df_soja, north_data, south_data, east_data, west_data):
+def update_lineplot2(df, municipalities, north_data, south_data, east_data, west_data):
     #print(f'north data: ', north_data)
     north_data = df
     # Drow two plot, you can select if you want to see north-south or west-east
-    productivity_data_north = productivity_to_df(north_data, df_soja)
-    productivity_data_south = productivity_to_df(south_data, df_soja)
+    productivity_data_north = productivity_to_df(north_data, municipalities)
+    productivity_data_south = productivity_to_df(south_data, municipalities)
     # Index List of Non-Outliers
     nonOutlierList_north = Remove_Outlier_Indices(productivity_data_north['productivity'])
     # Non-Outlier Subset of the Given Dataset
@@ -624,13 +980,26 @@ def update_lineplot2(df, df_soja, north_data, south_data, east_data, west_data):
 
 
 
-def create_dash(df, df_soja):
+def create_dash(df, df_soja, cube=None, productivity_totals=None, map_cache_mb=MAP_CACHE_MB, map_cache_folder=None,
+                map_cache_namespace=None, map_mode='folium', color_scale='linear'):
     """
     Create a Dash application for visualizing agroclimatology data.
 
+    In the 'folium' map mode, the whole Folium document is rendered for each
+    selection. In the 'data' mode, the map and its stations are created once
+    and each selection only sends the colors and sizes of the markers.
+
     Args:
     - df (pd.DataFrame): The main DataFrame.
     - df_soja (pd.DataFrame): Secondary DataFrame for additional processing.
+    - cube (pd.DataFrame): The aggregate cube stored by extract_subfile. If None, it is computed from df.
+    - productivity_totals (dict): Total productivity of each year. If None, it is computed from df_soja.
+    - map_cache_mb (float): Size of the cache of the rendered maps, in megabytes. If 0, the maps are not cached.
+    - map_cache_folder (str): Directory where the rendered maps are also cached, to survive a restart.
+      If None, they are cached only in memory.
+    - map_cache_namespace (str): Version of the data the maps are rendered from, e.g. the key of the aggregate cube.
+    - map_mode (str): 'folium' or 'data'.
+    - color_scale (str): Scale of the colors of the map, 'linear' or 'quantile'.
 
     Returns:
     - dash.Dash: The created Dash application.
@@ -650,8 +1019,38 @@ def create_dash(df, df_soja):
         
     }
     
+    # Municipality table, names and productivities are looked up by 'codigo_ibge'
+    municipalities = build_municipality_dim(df_soja)
+    # Aggregates read by the charts instead of scanning the daily data
+    if cube is None:
+        cube = build_aggregate_cube(df, variables)
+    if productivity_totals is None:
+        productivity_totals = compute_productivity_totals(df_soja, df_soja.columns[3:])
+    # Rendered maps and their markers, by (year, month, day, variable)
+    if map_cache_mb:
+        # The namespace covers the rendering code as well as the data
+        namespace = f"{map_cache_namespace or 'default'}-render{MAP_RENDER_VERSION}"
+        map_cache = new_lru_cache(int(map_cache_mb * 2**20), map_cache_folder, namespace)
+        markers_cache = new_lru_cache(int(map_cache_mb * 2**20))
+    else:
+        map_cache, markers_cache = None, None
+
     # Create colormap and split dataset
-    colormap = generate_colormaps(df, variables)
+    colormap = generate_colormaps(df, variables, color_scale)
+    # Rows of each day, so that the map does not scan the whole DataFrame
+    date_index = build_date_index(df)
+    # Layer of the stations of the map, created once in the 'data' mode
+    if map_mode == 'data':
+        stations = station_layer(df, municipalities)
+        map_component = html.Div([
+            dcc.Graph(id='station-map', figure=create_station_map(stations), config={'displayModeBar': False}),
+            dcc.Store(id='map-data'),
+        ])
+        map_output = Output('map-data', 'data')
+    else:
+        stations = None
+        map_component = html.Iframe(id='map-iframe', width='100%', height='500')
+        map_output = Output('map-iframe', 'srcDoc')
     print(f'df = ',df)
     # Divide dataset depending on the position of the measurement
     [north_data, south_data, east_data, west_data] = divide_dataset(df)
@@ -666,6 +1065,10 @@ def create_dash(df, df_soja):
     east_data_year = east_data.groupby('year')
     west_data_year = west_data.groupby('year')
     #print(f'df = {df}')
+    # The productivity model does not depend on the selections, its figure is computed once
+    start = time.perf_counter()
+    intercept_fig = update_lineplot2(df, municipalities, north_data, south_data, east_data, west_data)
+    print(f'Productivity model figure: {time.perf_counter() - start:.3f} s')
     # Initialize the Dash app
     app = dash.Dash(__name__)
     # Define the layout of the dashboard
@@ -678,8 +1081,8 @@ def create_dash(df, df_soja):
             html.Label('Select Year:', style={'padding': '10px 0'}),
             dcc.Dropdown(
                 id='year-dropdown',
-                options=[{'label': year, 'value': year} for year in df['year'].unique()],
-                value=df['year'].min(),
+                options=[{'label': str(year), 'value': year} for year in sorted(df['year'].unique().tolist())],
+                value=int(df['year'].min()),
                 style={'width': '200px'}  # Adjust the width of the dropdown
             )
         ], style={'display': 'inline-block', 'padding-right': '20px'}),  # Style for Year dropdown
@@ -688,8 +1091,8 @@ def create_dash(df, df_soja):
             html.Label('Select Month:', style={'padding': '10px 0'}),
             dcc.Dropdown(
                 id='month-dropdown',
-                options=[{'label': month, 'value': month} for month in df['month'].unique()],
-                value=df['month'].min(),
+                options=[{'label': f'{month:02d}', 'value': month} for month in sorted(df['month'].unique().tolist())],
+                value=int(df['month'].min()),
                 style={'width': '200px'}
             )
         ], style={'display': 'inline-block', 'padding-right': '20px'}),  # Style for Month dropdown
@@ -698,8 +1101,8 @@ def create_dash(df, df_soja):
             html.Label('Select Day:', style={'padding': '10px 0'}),
             dcc.Dropdown(
                 id='day-dropdown',
-                options=[{'label': day, 'value': day} for day in df['day'].unique()],
-                value=df['day'].min(),
+                options=[{'label': f'{day:02d}', 'value': day} for day in sorted(df['day'].unique().tolist())],
+                value=int(df['day'].min()),
                 style={'width': '200px'}
             )
         ], style={'display': 'inline-block'})  # Style for Day dropdown
@@ -721,7 +1124,7 @@ def create_dash(df, df_soja):
         ], style={'display': 'flex', 'justify-content': 'center', 'padding-bottom': '20px'}),
 
         # Map component
-        html.Iframe(id='map-iframe', width='100%', height='500'),
+        map_component,
 
         
         # Dropdown for selecting the season
@@ -768,42 +1171,63 @@ def create_dash(df, df_soja):
 
         dcc.Graph(
             id='scatter_vars-plot',
+            figure=intercept_fig,
             config={'displayModeBar': False}
         ), 
     ], style={'font-family': 'Arial, sans-serif', 'margin': '20px','background-color': 'white'})  # Define font-family and set margin for the entire layout
 
-    # Update callback
+    # Each figure is updated only by the selections it depends on, the time of each callback is printed
     @app.callback(
-        [Output('map-iframe', 'srcDoc'),
-         Output('lat-hist', 'figure'),
-         Output('long-hist', 'figure'),
-         Output('scatter_years-plot', 'figure'),
-         Output('scatter_vars-plot', 'figure')],
+        map_output,
         [Input('year-dropdown', 'value'),
          Input('month-dropdown', 'value'),
          Input('day-dropdown', 'value'),
+         Input('var-dropdown', 'value')]
+    )
+    def update_map_callback(selected_year, selected_month, selected_day, selected_var):
+        start = time.perf_counter()
+        if map_mode == 'data':
+            map_html = update_map_data(df, municipalities, stations, selected_year, selected_month, selected_day, selected_var,
+                                       colormap, map_cache, markers_cache, date_index)
+        else:
+            map_html = update_map(df, municipalities, selected_year, selected_month, selected_day, selected_var, variable_details, colormap,
+                                  map_cache, markers_cache, date_index)
+        if map_cache is not None:
+            print(f'Map cache: {lru_stats(map_cache)}')
+        print(f'Callback update_map: {time.perf_counter() - start:.3f} s')
+        return map_html
+
+    @app.callback(
+        [Output('lat-hist', 'figure'),
+         Output('long-hist', 'figure')],
+        [Input('year-dropdown', 'value'),
          Input('season-dropdown', 'value'),
-         Input('var-dropdown', 'value'),
-         #Input('data-dropdown', 'value')
-         ]
+         Input('var-dropdown', 'value')]
     )
+    def update_histogram_callback(selected_year, selected_season, selected_var):
+        start = time.perf_counter()
+        fig_lat, fig_long = update_histogram(selected_year, selected_season, selected_var, variable_details, north_data_year, south_data_year, east_data_year, west_data_year)
+        print(f'Callback update_histogram: {time.perf_counter() - start:.3f} s')
+        return fig_lat, fig_long
 
-    
-    def update_map_and_graph(selected_year, selected_month, selected_day, selected_season, selected_var): # , selected_data):
-        # Map:
-        map_html = update_map(df, df_soja, selected_year, selected_month, selected_day, selected_var, variable_details, colormap)
-        
-        # Histogram:
-        # fig_NS, fig_EW = update_histogram(selected_year, selected_season, selected_var, north_data_year, south_data_year, east_data_year, west_data_year)
-        fig_lat, fig_long= update_histogram(selected_year, selected_season, selected_var, variable_details, north_data_year, south_data_year, east_data_year, west_data_year)
-        
-        # Lineplot
-        lineplot_fig_years = update_lineplot(selected_var, variable_details, df, df_soja)
-        # lineplot_fig_variables = scatterplot_with_dropdowns(df, variable_details)
-        ##lineplot_fig_variables = update_lineplot2(selected_var, variable_details,   selected_season, df, df_soja)  #ONLY ONE SEASON
-        #lineplot_fig_variables =  update_lineplot2(selected_var, variable_details, df, df_soja) # ALL SEASON
-        intercept_fig = update_lineplot2(df, df_soja, north_data, south_data, east_data, west_data) #send only selected data
-        return map_html, fig_lat, fig_long, lineplot_fig_years, intercept_fig
+    @app.callback(
+        Output('scatter_years-plot', 'figure'),
+        Input('var-dropdown', 'value')
+    )
+    def update_lineplot_callback(selected_var):
+        start = time.perf_counter()
+        lineplot_fig_years = update_lineplot(selected_var, variable_details, cube, productivity_totals)
+        print(f'Callback update_lineplot: {time.perf_counter() - start:.3f} s')
+        return lineplot_fig_years
+
+    # The data of the map is applied to the stations in the browser
+    if map_mode == 'data':
+        app.clientside_callback(
+            APPLY_MAP_DATA,
+            Output('station-map', 'figure'),
+            Input('map-data', 'data'),
+            State('station-map', 'figure'),
+        )
     
     return app
     
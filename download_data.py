@@ -1,12 +1,35 @@
 import os
+import json
 import time
+import base64
+import hashlib
 import zipfile
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    # Without watchdog the download directory is checked at regular intervals
+    Observer = None
+    FileSystemEventHandler = object
+
+# Extensions of the files written by a browser while a download is in progress
+PARTIAL_DOWNLOAD_EXTENSIONS = ('.crdownload', '.part', '.tmp')
+
+# Kaggle API endpoint serving the archive of a dataset
+KAGGLE_DOWNLOAD_URL = 'https://www.kaggle.com/api/v1/datasets/download/{owner}/{dataset}'
+# File keeping the validators of the last HTTP download
+HTTP_STATE_FILE = 'http_state.json'
+
 
 
 
@@ -96,20 +119,18 @@ def check_last_update(update_date, url, driver, input_directory, output_director
     return zip_file_name
 
 
-def download_dataset(dataset_url, driver, local_directory):
+def clear_directory(local_directory, keep=()):
     """
-    Download the dataset from a webpage.
+    Remove the files of a directory.
 
     Args:
-        dataset_url (str): URL of the webpage to download the dataset.
-        driver (webdriver.Chrome): Instance of the Chrome WebDriver.
-        local_directory (str): Local directory for downloads.
-
-    Returns:
-        str: Name of the downloaded ZIP file.
+        local_directory (str): Directory to clear.
+        keep (tuple): Names of the files to keep.
     """
     for filename in os.listdir(local_directory):
         file_path = os.path.join(local_directory, filename)
+        if filename in keep:
+            continue
         try:
             if os.path.isfile(file_path):
                 os.remove(file_path)
@@ -119,6 +140,21 @@ def download_dataset(dataset_url, driver, local_directory):
         except Exception as e:
             print(f"Error in removing {filename}: {e}")
 
+
+def download_dataset(dataset_url, driver, local_directory):
+    """
+    Download the dataset from a webpage.
+
+    Args:
+        dataset_url (str): URL of the webpage to download the dataset.
+        driver (webdriver.Chrome): Instance of the Chrome WebDriver.
+        local_directory (str): Local directory for downloads.
+
+    Returns:
+        str: Name of the downloaded ZIP file.
+    """
+    clear_directory(local_directory)
+
     wait = WebDriverWait(driver, 30)
     wait.until(EC.url_to_be(dataset_url))
 
@@ -154,23 +190,9 @@ def download_dataset(dataset_url, driver, local_directory):
     download_button.click()
     print('Download running...')
 
-    downloaded_file = None
-    timeout = 480
-    start_time = time.time()
-
-    while time.time() - start_time < timeout:
-        try:
-            files = os.listdir(local_directory)
-            found_files = [file for file in files if file.endswith('.zip')]
-            if found_files:
-                downloaded_file = found_files[0]
-                print('File with .zip extension found:', downloaded_file)
-                break
-
-        except Exception as e:
-            print("Error occurred:", e)
-            time.sleep(10)
-
+    downloaded_file = wait_for_download(local_directory, timeout=480)
+    if downloaded_file:
+        print('File with .zip extension found:', downloaded_file)
     else:
         print("Download didn't complete within the timeout.")
 
@@ -178,6 +200,98 @@ def download_dataset(dataset_url, driver, local_directory):
     return downloaded_file
 
 
+class DirectoryChangeHandler(FileSystemEventHandler):
+    """
+    Signal every change in a watched directory through a threading.Event.
+    """
+    def __init__(self, changed):
+        self.changed = changed
+
+    def on_any_event(self, event):
+        self.changed.set()
+
+
+def find_complete_download(directory, sizes, stable_seconds):
+    """
+    Look for a completely downloaded .zip file in a directory.
+
+    A .zip file is complete when no partial download is left in the directory,
+    its size did not change for stable_seconds and it is a valid archive.
+
+    Args:
+        directory (str): Download directory.
+        sizes (dict): Last size of each .zip file and the time it was first seen, updated in place.
+        stable_seconds (float): Time the size must stay unchanged.
+
+    Returns:
+        str: Name of the complete .zip file, or None.
+        float: Seconds before a .zip file currently growing could become stable, or None.
+    """
+    files = os.listdir(directory)
+    if any(file.endswith(PARTIAL_DOWNLOAD_EXTENSIONS) for file in files):
+        return None, None
+    now = time.monotonic()
+    next_check = None
+    for file in sorted(file for file in files if file.endswith('.zip')):
+        try:
+            size = os.path.getsize(os.path.join(directory, file))
+        except OSError:
+            continue
+        if sizes.get(file, (None, None))[0] != size:
+            sizes[file] = (size, now)
+        stable_for = now - sizes[file][1]
+        if stable_for >= stable_seconds:
+            if zipfile.is_zipfile(os.path.join(directory, file)):
+                return file, None
+        else:
+            remaining = stable_seconds - stable_for
+            next_check = remaining if next_check is None else min(next_check, remaining)
+    return None, next_check
+
+
+def wait_for_download(directory, timeout=480, stable_seconds=1.0, poll_interval=1.0):
+    """
+    Wait until a .zip file is completely downloaded in a directory.
+
+    The directory is watched for file system events (with watchdog, when it
+    is installed), so the check runs as soon as the browser renames or writes
+    a file instead of in a busy loop.
+
+    Args:
+        directory (str): Download directory.
+        timeout (float): Maximum time to wait, in seconds.
+        stable_seconds (float): Time the size of the file must stay unchanged.
+        poll_interval (float): Maximum time between two checks, in seconds.
+
+    Returns:
+        str: Name of the downloaded .zip file, or None if the timeout expired.
+    """
+    changed = threading.Event()
+    observer = None
+    if Observer is not None:
+        observer = Observer()
+        observer.schedule(DirectoryChangeHandler(changed), directory, recursive=False)
+        observer.start()
+
+    sizes = {}
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            changed.clear()
+            downloaded_file, next_check = find_complete_download(directory, sizes, stable_seconds)
+            if downloaded_file:
+                return downloaded_file
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            wait_time = poll_interval if next_check is None else min(next_check, poll_interval)
+            changed.wait(min(wait_time, remaining))
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
 def unzip_file(directory, zip_file_name):
     """
     Unzip a .zip file in the specified directory.
@@ -204,19 +318,262 @@ def unzip_file(directory, zip_file_name):
         print(f"An error occurred while extracting '{zip_file_name}': {e}")
 
 
-def dataset_check_download(url, input_folder_directory, output_folder_directory, chrome_driver_path, chrome_binary_location):
+def kaggle_download_url(url):
+    """
+    Build the URL of the Kaggle API serving the archive of a dataset.
+
+    Args:
+        url (str): URL of the dataset webpage, e.g. https://www.kaggle.com/datasets/<owner>/<dataset>/data.
+
+    Returns:
+        str: URL of the dataset archive.
+    """
+    parts = url.split('/datasets/', 1)[1].strip('/').split('/')
+    return KAGGLE_DOWNLOAD_URL.format(owner=parts[0], dataset=parts[1])
+
+
+def read_kaggle_credentials():
+    """
+    Read the Kaggle API credentials.
+
+    They are read from the KAGGLE_USERNAME and KAGGLE_KEY environment
+    variables, or else from the kaggle.json file of the Kaggle API.
+
+    Returns:
+        tuple: (username, key) for HTTP basic authentication, or None.
+    """
+    if os.environ.get('KAGGLE_USERNAME') and os.environ.get('KAGGLE_KEY'):
+        return os.environ['KAGGLE_USERNAME'], os.environ['KAGGLE_KEY']
+    kaggle_json = os.path.join(os.path.expanduser('~'), '.kaggle', 'kaggle.json')
+    try:
+        with open(kaggle_json, "r", encoding="utf-8") as file:
+            credentials = json.load(file)
+        return credentials['username'], credentials['key']
+    except (FileNotFoundError, KeyError, json.JSONDecodeError):
+        return None
+
+
+def initialize_session(auth=None, pool_size=4, retries=3):
+    """
+    Create an HTTP session reusing its connections, with retries on server errors.
+
+    Args:
+        auth (tuple): (username, key) for HTTP basic authentication.
+        pool_size (int): Number of connections kept open for each host.
+        retries (int): Number of retries of a failed request.
+
+    Returns:
+        requests.Session: The HTTP session.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['HEAD', 'GET'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.auth = auth
+    return session
+
+
+def read_http_state(output_directory):
+    """
+    Read the validators (ETag, Last-Modified, checksum) of the last HTTP download.
+
+    Args:
+        output_directory (str): Directory containing the state file.
+
+    Returns:
+        dict: The saved state, empty if there is none.
+    """
+    try:
+        with open(os.path.join(output_directory, HTTP_STATE_FILE), "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_http_state(output_directory, state):
+    """
+    Save the validators of the last HTTP download.
+
+    Args:
+        output_directory (str): Directory containing the state file.
+        state (dict): The state to save.
+    """
+    with open(os.path.join(output_directory, HTTP_STATE_FILE), "w", encoding="utf-8") as file:
+        json.dump(state, file, indent=2)
+
+
+def expected_md5(headers):
+    """
+    Read the MD5 checksum of the whole file announced by the server, if any.
+
+    Args:
+        headers (dict): Headers of the HTTP response.
+
+    Returns:
+        str: Hexadecimal MD5 checksum, or None.
+    """
+    for value in (headers.get('x-goog-hash', '') + ',' + 'md5=' + headers.get('Content-MD5', '')).split(','):
+        name, _, encoded = value.strip().partition('=')
+        if name == 'md5' and encoded:
+            return base64.b64decode(encoded).hex()
+    return None
+
+
+def file_checksums(file_path, block_size=1 << 20):
+    """
+    Compute the MD5 and SHA-256 checksums of a file.
+
+    Args:
+        file_path (str): Path of the file.
+        block_size (int): Number of bytes read at each step.
+
+    Returns:
+        str: Hexadecimal MD5 checksum.
+        str: Hexadecimal SHA-256 checksum.
+    """
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            md5.update(block)
+            sha256.update(block)
+    return md5.hexdigest(), sha256.hexdigest()
+
+
+def http_download(session, download_url, local_directory, zip_file_name, state, expected_sha256=None,
+                  chunk_size=1 << 16):
+    """
+    Download the dataset archive over HTTP if it changed since the last download.
+
+    The request is conditional (If-None-Match / If-Modified-Since), so an
+    unchanged dataset costs a single 304 response. An interrupted download
+    is kept as a .part file and resumed with a Range request, guarded by
+    If-Range so that a new version restarts from the beginning. The archive
+    is verified against the checksum announced by the server, or the given
+    one, before replacing the previous archive.
+
+    Args:
+        session (requests.Session): The HTTP session.
+        download_url (str): URL of the dataset archive.
+        local_directory (str): Local directory for downloads.
+        zip_file_name (str): Name of the downloaded archive.
+        state (dict): Validators of the last download, updated in place.
+        expected_sha256 (str): SHA-256 checksum the archive must have, if known.
+        chunk_size (int): Number of bytes written at each step.
+
+    Returns:
+        str: Name of the downloaded ZIP file, or None if the dataset is not updated or the download failed.
+    """
+    zip_file_path = os.path.join(local_directory, zip_file_name)
+    part_path = zip_file_path + '.part'
+    headers = {}
+    if os.path.exists(zip_file_path):
+        if state.get('etag'):
+            headers['If-None-Match'] = state['etag']
+        if state.get('last_modified'):
+            headers['If-Modified-Since'] = state['last_modified']
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset and state.get('partial_validator'):
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = state['partial_validator']
+
+    with session.get(download_url, headers=headers, stream=True, timeout=(10, 60)) as response:
+        if response.status_code == 304:
+            print('Dataset is not updated. No need to download.')
+            return None
+        if response.status_code == 416:
+            print('The partial download can not be resumed, it will be downloaded again.')
+            os.remove(part_path)
+            state.pop('partial_validator', None)
+            return None
+        response.raise_for_status()
+        if response.status_code != 206:
+            # The server sent the whole file: start again from the beginning
+            offset = 0
+        else:
+            print(f'Resuming the download from byte {offset}.')
+        # Remember which version the .part file belongs to, to resume it later
+        state['partial_validator'] = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        with open(part_path, 'ab' if offset else 'wb') as file:
+            for block in response.iter_content(chunk_size=chunk_size):
+                file.write(block)
+        announced_md5 = expected_md5(response.headers)
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+    md5, sha256 = file_checksums(part_path)
+    if (announced_md5 and announced_md5 != md5) or (expected_sha256 and expected_sha256 != sha256) \
+            or not zipfile.is_zipfile(part_path):
+        print('The downloaded file is corrupted, it will be downloaded again.')
+        os.remove(part_path)
+        state.pop('partial_validator', None)
+        return None
+
+    os.replace(part_path, zip_file_path)
+    state.pop('partial_validator', None)
+    state.update({'etag': etag, 'last_modified': last_modified, 'sha256': sha256, 'file': zip_file_name})
+    return zip_file_name
+
+
+def http_check_download(url, input_folder_directory, output_folder_directory, download_url=None,
+                        expected_sha256=None):
+    """
+    Check and download the dataset over HTTP, without a browser.
+
+    Args:
+        url (str): URL of the dataset webpage.
+        input_folder_directory (str): Local directory for downloads.
+        output_folder_directory (str): Directory keeping the validators of the last download.
+        download_url (str): URL of the dataset archive. If None, the Kaggle API URL of the dataset.
+        expected_sha256 (str): SHA-256 checksum the archive must have, if known.
+
+    Returns:
+        str: Name of the downloaded ZIP file, or None.
+    """
+    download_url = download_url or kaggle_download_url(url)
+    zip_file_name = download_url.rstrip('/').split('/')[-1].split('?')[0]
+    if not zip_file_name.endswith('.zip'):
+        zip_file_name += '.zip'
+    state = read_http_state(output_folder_directory)
+    downloaded_file = None
+    try:
+        with initialize_session(auth=read_kaggle_credentials()) as session:
+            downloaded_file = http_download(session, download_url, input_folder_directory, zip_file_name,
+                                            state, expected_sha256)
+    except requests.RequestException as e:
+        print(f"Error: {e}. The download will be resumed at the next run.")
+    finally:
+        write_http_state(output_folder_directory, state)
+    if downloaded_file:
+        # Remove the files of the previous version once the new one is verified
+        clear_directory(input_folder_directory, keep=(downloaded_file, downloaded_file + '.part'))
+    return downloaded_file
+
+
+def dataset_check_download(url, input_folder_directory, output_folder_directory, chrome_driver_path=None,
+                           chrome_binary_location=None, method='selenium', download_url=None):
 
     """
-    Function to orchestrate the process of checking, 
-    downloading, and unzipping the dataset.
+    Function to orchestrate the process of checking 
+    and downloading the dataset.
+
+    With method='selenium' the Kaggle webpage is opened in Chrome, with
+    method='http' the archive is fetched directly over HTTP.
+
+    The downloaded .zip archive is not extracted: the CSV files are
+    read directly from the archive by the processing pipeline.
     """
-    driver = initialize_driver(input_folder_directory, chrome_driver_path, chrome_binary_location)
-    data = find_last_update(url, driver)
-    if data: 
-        zip_file_name = check_last_update(data, url, driver, input_folder_directory, output_folder_directory)
+    zip_file_name = None
+    if method == 'http':
+        zip_file_name = http_check_download(url, input_folder_directory, output_folder_directory, download_url)
     else:
-        print('Element not found or timed out')
+        driver = initialize_driver(input_folder_directory, chrome_driver_path, chrome_binary_location)
+        data = find_last_update(url, driver)
+        if data: 
+            zip_file_name = check_last_update(data, url, driver, input_folder_directory, output_folder_directory)
+        else:
+            print('Element not found or timed out')
     
     if zip_file_name:
-        unzip_file(input_folder_directory, zip_file_name) 
+        print(f"Dataset downloaded in '{zip_file_name}', its CSV files are read from the archive.")
 
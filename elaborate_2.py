@@ -1,32 +1,392 @@
+import io
 import os
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+import numpy as np
 import pandas as pd
+try:
+    import polars as pl
+except ImportError:
+    # Without polars only the pandas engine is available
+    pl = None
+from store_data import compute_cache_key, load_cached_frame, save_cached_frame, save_cached_chunks, \
+    read_aggregate_cube_key, read_aggregate_cube_metadata, save_aggregate_cube, \
+    load_refreshable_frame, save_partition_hashes, read_partitioned_metadata, write_partitioned_store, \
+    iter_cached_chunks
+from validate_data import VALIDATION_CHECKS, validate_frame, merge_validation_reports, print_validation_report
+from run_report import new_run_report, measure_stage, run_stage, finish_run_report, write_run_report, \
+    print_run_report
 
-def find_and_read_csv(directory):
+# Columns kept in the processed DataFrame
+COLUMNS_TO_KEEP = ['year', 'month', 'day',
+                   'codigo_ibge', 'latitude', 'longitude',
+                   'TS', 'PS', 'GWETROOT'
+                   ]
+
+# Columns read from the climate CSV file and their types
+CLIMATE_USECOLS = ['data', 'codigo_ibge', 'latitude', 'longitude', 'TS', 'PS', 'GWETROOT']
+CLIMATE_DTYPES = {
+    'data': 'int32',
+    'codigo_ibge': 'int32',
+    'TS': 'float32',
+    'PS': 'float32',
+    'GWETROOT': 'float32',
+}
+
+# Columns identifying the climate CSV file
+CLIMATE_KEY_COLUMNS = {'data', 'codigo_ibge'}
+
+# Types given to the CSV parser when some measurements are not numbers: only
+# the key columns are parsed strictly, the measurements reach the validator
+# as text and get their types of CLIMATE_DTYPES afterwards
+CLIMATE_LENIENT_DTYPES = {column: dtype for column, dtype in CLIMATE_DTYPES.items() if column in CLIMATE_KEY_COLUMNS}
+
+# The key of a (year, month, station) partition is yyyymm followed by the 7 digits of the station code
+STATION_KEY_FACTOR = 10 ** 7
+
+# Below this size of the climate file, in bytes, starting worker processes
+# costs more than it saves: the file is processed in the main process
+PARALLEL_MIN_BYTES = 64 << 20
+
+# Errors raised when a key column of the climate CSV file can not be parsed
+PARSE_ERRORS = (ValueError,) if pl is None else (ValueError, pl.exceptions.ComputeError)
+
+# Seasons with their corresponding start and end dates (month, day)
+SEASONS = [
+    ('Summer', ('01', '01'), ('03', '20')),
+    ('Autumn', ('03', '21'), ('06', '20')),
+    ('Winter', ('06', '21'), ('09', '22')),
+    ('Spring', ('09', '23'), ('12', '20')),
+    ('Summer', ('12', '21'), ('12', '31'))
+]
+
+# Number of days before the first day of each month in a leap year
+MONTH_OFFSETS = np.array([0, 31, 60, 91, 121, 152, 182, 213, 244, 274, 305, 335])
+
+# Ratio between the memory needed to process a chunk and the memory of the raw chunk
+PROCESSING_OVERHEAD = 4
+
+# Number of rows parsed at once when the climate CSV file is filtered while it is read
+READ_CHUNK_ROWS = 500000
+
+# Engines available to process the climate data in memory
+ENGINES = ('pandas', 'polars')
+
+# Climate variables of the processed DataFrame
+CLIMATE_VARIABLES = ['TS', 'PS', 'GWETROOT']
+
+# Statistics of each variable in the aggregate cube
+CUBE_STATISTICS = ['mean', 'min', 'max', 'std', 'count', 'sum']
+CUBE_KEYS = ['year', 'season', 'codigo_ibge', 'ns_region', 'ew_region']
+
+# Number of rows aggregated at once when the aggregate cube is built
+CUBE_CHUNK_ROWS = 1 << 20
+
+
+def list_csv_sources(directory):
+    """
+    List the CSV files in a directory, including the CSV files inside .zip archives.
+
+    A CSV file inside an archive is read directly from the archive, so the
+    downloaded dataset does not need to be extracted.
+
+    Args:
+    - directory (str): The directory path where CSV files or archives are located.
+
+    Returns:
+    - list: The CSV sources, a path for a CSV file or an (archive path, member name)
+      tuple for a CSV file inside an archive.
+    """
+    sources = []
+    for file in sorted(os.listdir(directory)):
+        file_path = os.path.join(directory, file)
+        if file.endswith('.csv'):
+            sources.append(file_path)
+        elif file.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file_path, 'r') as zip_ref:
+                    sources.extend((file_path, member) for member in zip_ref.namelist() if member.endswith('.csv'))
+            except zipfile.BadZipFile:
+                print(f"The file '{file}' is not a valid .zip file.")
+    return sources
+
+
+def source_name(source):
+    """
+    Return the file name of a CSV source.
+    """
+    return source[1] if isinstance(source, tuple) else os.path.basename(source)
+
+
+@contextmanager
+def open_binary_source(source):
+    """
+    Open a CSV source as a binary file, without extracting it when it is inside an archive.
+
+    Args:
+    - source (str or tuple): Path of a CSV file or (archive path, member name) tuple.
+
+    Yields:
+    - The binary file object.
+    """
+    if isinstance(source, tuple):
+        archive_path, member = source
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref, zip_ref.open(member) as file:
+            yield file
+    else:
+        with open(source, 'rb') as file:
+            yield file
+
+
+def source_size(source):
+    """
+    Return the size in bytes of a CSV source, uncompressed when it is inside an archive.
+    """
+    if isinstance(source, tuple):
+        archive_path, member = source
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            return zip_ref.getinfo(member).file_size
+    return os.path.getsize(source)
+
+
+@contextmanager
+def open_csv_source(source):
+    """
+    Open a CSV source for reading, without extracting it when it is inside an archive.
+
+    Args:
+    - source (str or tuple): Path of a CSV file or (archive path, member name) tuple.
+
+    Yields:
+    - The path or file object to pass to pd.read_csv.
+    """
+    if isinstance(source, tuple):
+        archive_path, member = source
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref, zip_ref.open(member) as file:
+            yield file
+    else:
+        yield source
+
+
+def read_csv_source(source, **kwargs):
     """
-    Find and read CSV files in the specified directory.
+    Read a CSV source with pd.read_csv.
+
+    Args:
+    - source (str or tuple): Path of a CSV file or (archive path, member name) tuple.
+    - **kwargs: Options passed to pd.read_csv.
+
+    Returns:
+    - pd.DataFrame: DataFrame read from the CSV source.
+    """
+    with open_csv_source(source) as file:
+        return pd.read_csv(file, **kwargs)
+
+
+def read_csv_header(source):
+    """
+    Read the column names of a CSV source without parsing its rows.
+
+    Args:
+    - source (str or tuple): Path of a CSV file or (archive path, member name) tuple.
+
+    Returns:
+    - list: Column names, stripped of extra spaces.
+    """
+    return [column.strip() for column in read_csv_source(source, nrows=0).columns]
+
+
+def is_climate_schema(columns):
+    """
+    Check whether the columns are those of the climate CSV file.
+    """
+    return CLIMATE_KEY_COLUMNS.issubset(columns)
+
+
+def is_productivity_schema(columns):
+    """
+    Check whether the columns are those of the productivity CSV file.
+    """
+    return 'name' in columns and any(column.isdigit() and len(column) == 4 for column in columns)
+
+
+def find_csv_files(directory):
+    """
+    Find the climate and productivity CSV files in the specified directory.
+
+    The files are recognised by their header: the climate file has the 'data'
+    and 'codigo_ibge' columns, the productivity file has a 'name' column and
+    one column per year. Other CSV files are ignored. CSV files inside .zip
+    archives are considered as well.
 
     Args:
     - directory (str): The directory path where CSV files are located.
 
     Returns:
-    - pd.DataFrame: DataFrame read from the largest CSV file.
-    - pd.DataFrame: DataFrame read from the smallest CSV file.
+    - str or tuple: Source of the climate CSV file.
+    - str or tuple: Source of the productivity CSV file.
     """
-    # Find all CSV files in the directory
-    csv_files = [file for file in os.listdir(directory) if file.endswith('.csv')]
+    # Find all CSV files in the directory and in its archives
+    csv_sources = list_csv_sources(directory)
     # If no CSV files are found, inform the user and return None
-    if not csv_files:
+    if not csv_sources:
         print("No CSV files found in the directory.")
         return None, None
-    # Get the size of each CSV file and sort them based on file size
-    file_sizes = {file: os.path.getsize(os.path.join(directory, file)) for file in csv_files}
-    sorted_files = sorted(file_sizes.items(), key=lambda x: x[1])
-    # Get the largest and smallest CSV files based on size
-    largest_file, smallest_file = sorted_files[-1][0], sorted_files[0][0] 
-    # Read the largest and smallest CSV files into DataFrames
-    df = pd.read_csv(os.path.join(directory, largest_file))
-    df_soja= pd.read_csv(os.path.join(directory, smallest_file))
-    return df, df_soja  # Return the DataFrames for the largest and smallest CSV files
+    climate_source, productivity_source = None, None
+    for source in csv_sources:
+        try:
+            columns = read_csv_header(source)
+        except Exception as e:
+            print(f"Error: {e}. File {source_name(source)} ignored.")
+            continue
+        if is_climate_schema(columns) and climate_source is None:
+            climate_source = source
+        elif is_productivity_schema(columns) and productivity_source is None:
+            productivity_source = source
+        else:
+            print(f"File {source_name(source)} ignored.")
+    if climate_source is None or productivity_source is None:
+        print("Climate or productivity CSV file not found in the directory.")
+        return None, None
+    return climate_source, productivity_source
+
+
+def read_productivity_csv(source):
+    """
+    Read the soybean productivity CSV file.
+
+    Args:
+    - source (str or tuple): Source of the productivity CSV file.
+
+    Returns:
+    - pd.DataFrame: The productivity DataFrame with stripped column names.
+    """
+    df_soja = read_csv_source(source)
+    # Remove extra spaces in column names
+    df_soja.rename(columns=lambda x: x.strip(), inplace=True)
+    return df_soja
+
+
+def filter_raw_rows(dataframe, productivity_years):
+    """
+    Keep only the rows of the productivity years of a raw climate DataFrame.
+
+    The year is taken from the integer 'data' column (yyyymmdd), so the rows
+    are filtered before any date column is built.
+
+    Args:
+    - dataframe (pd.DataFrame): The raw climate DataFrame, or a chunk of it.
+    - productivity_years (list): List of years considered as productivity years.
+
+    Returns:
+    - pd.DataFrame: The rows of the productivity years.
+    """
+    try:
+        years = np.asarray(dataframe['data'], dtype=np.int64) // 10000
+        return dataframe[np.isin(years, [int(year) for year in productivity_years])]
+    except KeyError as e:
+        print(f"Error: {e}. 'data' column not found, the rows are filtered after processing.")
+        return dataframe
+
+
+def iter_climate_chunks(source, chunksize, usecols=None, dtype=None):
+    """
+    Read the climate CSV file chunk by chunk, parsing the columns with the given types.
+
+    If a measurement is not a number, the parser fails on its chunk: the file
+    is read again from that chunk on with the measurements parsed leniently
+    (see CLIMATE_LENIENT_DTYPES), so that the validator counts and converts
+    them. A key column which can not be parsed fails again, the error is raised.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - chunksize (int): Number of rows of each chunk.
+    - usecols (list): Columns to parse. If None, every column is parsed.
+    - dtype (dict): Type of each parsed column. If None, the types are inferred.
+
+    Yields:
+    - pd.DataFrame: The chunks, in the order of the file.
+    """
+    lenient_dtype = None if dtype is None else {column: column_type for column, column_type in dtype.items()
+                                                  if column in CLIMATE_KEY_COLUMNS}
+    read_rows = 0
+    while True:
+        # The rows of the chunks already read are skipped, the header is kept
+        skiprows = (lambda row, skipped=read_rows: 0 < row <= skipped) if read_rows else None
+        with open_csv_source(source) as file, \
+                pd.read_csv(file, chunksize=chunksize, usecols=usecols, dtype=dtype, skiprows=skiprows) as reader:
+            try:
+                for chunk in reader:
+                    read_rows += len(chunk)
+                    yield chunk
+                return
+            except ValueError:
+                if dtype == lenient_dtype:
+                    raise
+        print('Some values of the climate file are not numbers, it is read again leniently.')
+        dtype = lenient_dtype
+
+
+def read_climate_csv(source, usecols=None, dtype=None, productivity_years=None):
+    """
+    Read the climate CSV file, parsing only the requested columns with the given types.
+
+    The file is parsed chunk by chunk (see iter_climate_chunks). If
+    productivity_years is given, the rows of the other years are dropped
+    from each chunk as soon as it is parsed, so they are never held in memory all together. The pandas parser
+    still parses them: only the polars engine skips them while scanning
+    the file (see process_csv_lazy).
+    The memory saved with respect to parsing every column of the file as a
+    64-bit number, the default type of its columns, is reported.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - usecols (list): Columns to parse. If None, every column is parsed.
+    - dtype (dict): Type of each parsed column. If None, the types are inferred.
+    - productivity_years (list): If given, only the rows of these years are kept.
+
+    Returns:
+    - pd.DataFrame: DataFrame read from the CSV file.
+    """
+    chunks = []
+    parsed_rows = 0
+    for chunk in iter_climate_chunks(source, READ_CHUNK_ROWS, usecols, dtype):
+        parsed_rows += len(chunk)
+        chunks.append(chunk if productivity_years is None else filter_raw_rows(chunk, productivity_years))
+    df = pd.concat(chunks, ignore_index=True) if chunks else read_csv_source(source, nrows=0, usecols=usecols, dtype=dtype)
+    if productivity_years is not None:
+        print(f"Skipped {parsed_rows - len(df)} of {parsed_rows} rows outside the productivity years.")
+    if usecols is not None or dtype is not None:
+        # The estimate only needs the header, the rows are not parsed again
+        full_bytes = len(read_csv_header(source)) * 8 * parsed_rows
+        read_bytes = df.memory_usage(deep=True).sum()
+        print(f"Read {len(df)} rows in {read_bytes / 2**20:.1f} MB, "
+              f"about {(full_bytes - read_bytes) / 2**20:.1f} MB saved by the row, column and type selection.")
+    return df
+
+
+def read_csv_files(climate_source, productivity_source, usecols=None, dtype=None, productivity_years=None):
+    """
+    Read the climate and productivity CSV files concurrently.
+
+    Args:
+    - climate_source (str or tuple): Source of the climate CSV file.
+    - productivity_source (str or tuple): Source of the productivity CSV file.
+    - usecols (list): Columns to parse in the climate CSV file. If None, every column is parsed.
+    - dtype (dict): Type of the parsed columns of the climate CSV file. If None, the types are inferred.
+    - productivity_years (list): If given, only the climate rows of these years are kept.
+
+    Returns:
+    - pd.DataFrame: DataFrame read from the climate CSV file.
+    - pd.DataFrame: DataFrame read from the productivity CSV file.
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        df_future = executor.submit(read_climate_csv, climate_source, usecols, dtype,
+                                    productivity_years=productivity_years)
+        df_soja_future = executor.submit(read_productivity_csv, productivity_source)
+        return df_future.result(), df_soja_future.result()
 
 
 # def filter_rows(dataframe, productivity_years):
@@ -66,6 +426,9 @@ def filter_rows(dataframe, productivity_years):
     - pd.DataFrame: Filtered DataFrame containing rows only with 'year' values present in productivity_years.
     """
     try:
+        # The productivity years are column names, compare them as numbers with a numeric 'year'
+        if pd.api.types.is_numeric_dtype(dataframe['year']):
+            productivity_years = [int(year) for year in productivity_years]
         filtered_dataframe = dataframe[dataframe['year'].isin(productivity_years)].copy()
         return filtered_dataframe
     except KeyError as e:
@@ -98,123 +461,1001 @@ def drop_columns(dataframe, columns_to_keep):
         return pd.DataFrame()  # Return an empty DataFrame in case of an error
 
 
-def assign_date(dataframe):
+def assign_date(dataframe, with_datetime=False):
     """
     Assign 'year', 'month', and 'day' columns based on the 'data' column.
 
+    The 'data' column (YYYYMMDD) is parsed once as an integer and split with
+    integer arithmetic into compact int16/int8 columns.
+
     Args:
     - dataframe (pd.DataFrame): The DataFrame to process.
+    - with_datetime (bool): Whether to add also a 'date' column of type datetime64.
 
     Returns:
     - pd.DataFrame: DataFrame with 'year', 'month', and 'day' columns added.
     """
     try:
         # Extract 'year', 'month', and 'day' from the 'data' column
-        dataframe['year'] = dataframe['data'].astype(str).str[:4]
-        dataframe['month'] = dataframe['data'].astype(str).str[4:6]
-        dataframe['day'] = dataframe['data'].astype(str).str[6:8]
+        data = pd.to_numeric(dataframe['data']).to_numpy(dtype=np.int64)
+        year = data // 10000
+        month = data // 100 % 100
+        day = data % 100
+        dataframe['year'] = year.astype(np.int16)
+        dataframe['month'] = month.astype(np.int8)
+        dataframe['day'] = day.astype(np.int8)
+        if with_datetime:
+            first_of_month = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') \
+                + (month - 1).astype('timedelta64[M]')
+            dataframe['date'] = first_of_month.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
         return dataframe
     except KeyError as e:
         print(f"Error: {e}. 'data' column not found.")
         return pd.DataFrame()  # Return an empty DataFrame in case of an error
 
-def add_name_ibge(df, df_soja):
+
+def day_of_year(month, day):
+    """
+    Convert months and days to the ordinal day of a leap year (0 to 365).
+
+    Args:
+    - month (np.ndarray): Months, from 1 to 12.
+    - day (np.ndarray): Days of the month, from 1 to 31.
+
+    Returns:
+    - np.ndarray: Ordinal day of the year of each date.
+    """
+    return MONTH_OFFSETS[month - 1] + day - 1
+
+
+def build_season_lookup(seasons):
+    """
+    Build a table giving the season of every day of a leap year.
+
+    Args:
+    - seasons (list): Seasons with their start and end (month, day) as strings.
+
+    Returns:
+    - np.ndarray: Array of 366 season labels, 'Unknown' for days not in any season.
+    """
+    lookup = np.full(366, 'Unknown', dtype=object)
+    # Fill in reverse order so that the first matching season wins, as in the table
+    for season, (start_month, start_day), (end_month, end_day) in reversed(seasons):
+        start = day_of_year(int(start_month), int(start_day))
+        end = day_of_year(int(end_month), int(end_day))
+        lookup[start:end + 1] = season
+    return lookup
+
+
+def build_municipality_dim(df_soja):
+    """
+    Build the municipality table, keyed by 'codigo_ibge'.
+
+    The processed DataFrame stores only the integer 'codigo_ibge' of each
+    row: names and productivities are looked up in this table when needed.
+
+    Args:
+    - df_soja (pd.DataFrame): The productivity DataFrame.
+
+    Returns:
+    - pd.DataFrame: One row per municipality, indexed by 'codigo_ibge' and sorted,
+      with the 'name' column and one productivity column per year.
+    """
+    return df_soja.drop_duplicates('codigo_ibge').set_index('codigo_ibge').sort_index()
+
+
+def lookup_municipalities(codes, municipalities, column='name'):
     """
-    Merge DataFrames to add the 'name_ibge' column.
+    Look up a column of the municipality table for an array of 'codigo_ibge'.
 
     Args:
-    - df (pd.DataFrame): The primary DataFrame.
-    - df_soja (pd.DataFrame): The secondary DataFrame.
+    - codes (array-like): The 'codigo_ibge' to look up.
+    - municipalities (pd.DataFrame): The municipality table.
+    - column (str): The column to return, e.g. 'name' or a year.
 
     Returns:
-    - pd.DataFrame: Merged DataFrame with 'name_ibge' column added.
+    - np.ndarray: The value of the column for each code, NaN for unknown codes.
     """
-    # Merge the primary and secondary DataFrames on the 'codigo_ibge' column, adding 'name_ibge'
-    merged_df = df.merge(df_soja[['codigo_ibge', 'name']], on='codigo_ibge', how='left')
-    # Rename the 'name' column to 'name_ibge' for clarity
-    merged_df = merged_df.rename(columns={'name': 'name_ibge'})
-    return merged_df
+    positions = municipalities.index.get_indexer(np.asarray(codes))
+    values = municipalities[column].to_numpy()[positions]
+    if (positions < 0).any():
+        values = values.astype(object)
+        values[positions < 0] = np.nan
+    return values
 
 
-def assign_seasons(dataframe):
+def assign_seasons(dataframe, seasons=SEASONS):
     """
-    Assign 'season' column based on 'year', 'month', and 'day' columns.
+    Assign 'season' column based on 'month' and 'day' columns.
+
+    Each date is converted to its ordinal day of the year, which indexes a
+    precomputed table of the seasons.
 
     Args:
     - dataframe (pd.DataFrame): The DataFrame to process.
+    - seasons (list): Seasons with their start and end (month, day) as strings.
 
     Returns:
     - pd.DataFrame: DataFrame with 'season' column added.
     """
-    # Define the seasons with their corresponding start and end dates
-    seasons = [
-        ('Summer', ('01', '01'), ('03', '20')),
-        ('Autumn', ('03', '21'), ('06', '20')),
-        ('Winter', ('06', '21'), ('09', '22')),
-        ('Spring', ('09', '23'), ('12', '20')),
-        ('Summer', ('12', '21'), ('12', '31'))
-    ]
-    # Define a function to assign seasons based on month and day values
-    def assign_season(row):
-        month, day = row['month'], row['day']
-        # Loop through the defined seasons and check for the matching period
-        for season, (start_month, start_day), (end_month, end_day) in seasons:
-            if (start_month <= month <= end_month) and (
-                    (start_month != month or start_day <= day) and (
-                        end_month != month or end_day >= day)
-            ):
-                return season
-        # If no match found, label it as 'Unknown'
-        return 'Unknown'
-
-    # Apply the function to the DataFrame to create a new 'season' column
-    dataframe['season'] = dataframe.apply(assign_season, axis=1)
+    lookup = SEASON_LOOKUP if seasons is SEASONS else build_season_lookup(seasons)
+    month = pd.to_numeric(dataframe['month'], errors='coerce').to_numpy(dtype=float)
+    day = pd.to_numeric(dataframe['day'], errors='coerce').to_numpy(dtype=float)
+    # Dates that can not be placed in the calendar are labelled as 'Unknown'
+    valid = (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31)
+    ordinal = np.zeros(len(dataframe), dtype=np.int64)
+    ordinal[valid] = day_of_year(month[valid].astype(np.int64), day[valid].astype(np.int64))
+    labels = np.take(lookup, ordinal)
+    labels[~valid] = 'Unknown'
+    dataframe['season'] = labels
     return dataframe
 
 
-def extract_subfile(input_folder, output_folder):
+# Season of every day of the year, indexed by day_of_year
+SEASON_LOOKUP = build_season_lookup(SEASONS)
+
+
+def process_frame(df, columns_to_keep, productivity_years, run_report=None):
     """
-    Extract and process data, saving the result in an output folder.
+    Apply the processing steps to a raw DataFrame (or to a chunk of it).
+
+    The municipalities are identified only by their 'codigo_ibge': their
+    names are kept in the municipality table (see build_municipality_dim).
 
     Args:
-    - input_folder (str): The directory path containing input CSV files.
-    - output_folder (str): The directory path to save the processed CSV file.
+    - df (pd.DataFrame): The raw climate DataFrame.
+    - columns_to_keep (list): List of columns to keep in the DataFrame.
+    - productivity_years (list): List of years considered as productivity years.
+    - run_report (dict): If given, each step is measured in this run report.
 
     Returns:
     - pd.DataFrame: The processed DataFrame.
-    - pd.DataFrame: Secondary DataFrame for additional processing.
     """
-    # Define the path for the output file
-    output_file_path = os.path.join(output_folder, "filtered_data.csv")
-    # Read the primary and secondary CSV files
-    df, df_soja = find_and_read_csv(input_folder) 
-    # Process the primary DataFrame by assigning 'year', 'month', and 'day' columns
-    df = assign_date(df) 
-    # Define columns to keep in the DataFrame
-    columns_to_keep = ['year', 'month', 'day', 
-                      'codigo_ibge', 'latitude', 'longitude', 
-                      'TS', 'PS', 'GWETROOT'
-                    ]
+    # Assign 'year', 'month', and 'day' columns
+    df = run_stage(run_report, 'assign_date', assign_date, df)
     # Drop columns not present in the 'columns_to_keep' list
-    df = drop_columns(df, columns_to_keep)
+    df = run_stage(run_report, 'drop_columns', drop_columns, df, columns_to_keep)
+    # Filter the DataFrame based on the productivity years
+    df = run_stage(run_report, 'filter_rows', filter_rows, df, productivity_years)
+    # Assign 'season' column based on 'month', and 'day'
+    return run_stage(run_report, 'assign_seasons', assign_seasons, df)
 
-    # Remove extra spaces in column names in the secondary DataFrame
-    df_soja.rename(columns=lambda x: x.strip(), inplace=True)
-    # Define the year range for filtering the DataFrame
-    productivity_years = df_soja.columns[3:]  # Seleziona solo le colonne degli anni
+
+def read_source_range(source, start, end):
+    """
+    Read the lines of a CSV source starting in a range of bytes.
+
+    A line belongs to the range where its first byte is, so consecutive
+    ranges split the file into whole lines, each line in exactly one range.
+
+    Args:
+    - source (str or tuple): Path of a CSV file or (archive path, member name) tuple.
+    - start (int): First byte of the range, after the header.
+    - end (int): Byte after the end of the range.
+
+    Returns:
+    - bytes: The lines starting in the range.
+    """
+    with open_binary_source(source) as file:
+        # Skip the end of the line containing the byte before the range
+        file.seek(start - 1)
+        file.readline()
+        position = file.tell()
+        if position >= end:
+            return b''
+        data = file.read(end - position)
+        if data and not data.endswith(b'\n'):
+            data += file.readline()
+        return data
+
+
+def process_csv_range(source, start, end, names, productivity_years, validation_checks=None):
+    """
+    Read, validate and process the lines of the climate CSV file starting in a range of bytes.
+
+    It runs in a worker process: only the range and the processed rows are
+    exchanged with the main process.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - start (int): First byte of the range, after the header.
+    - end (int): Byte after the end of the range.
+    - names (list): Column names of the file.
+    - productivity_years (list): List of years considered as productivity years.
+    - validation_checks (dict): Checks applied to the rows (see validate_data). If None, no check is applied.
+
+    Returns:
+    - pd.DataFrame: The processed rows, or None if no line starts in the range.
+    - dict: Violation counts by column and check.
+    - float: CPU time spent by the worker, in seconds.
+    """
+    start_time = time.process_time()
+    data = read_source_range(source, start, end)
+    if not data:
+        return None, {}, time.process_time() - start_time
+    try:
+        df = pd.read_csv(io.BytesIO(data), header=None, names=names, usecols=CLIMATE_USECOLS, dtype=CLIMATE_DTYPES)
+    except ValueError:
+        # Some measurements are not numbers, they are parsed leniently for the validator
+        df = pd.read_csv(io.BytesIO(data), header=None, names=names, usecols=CLIMATE_USECOLS,
+                         dtype=CLIMATE_LENIENT_DTYPES)
+    del data
+    df = filter_raw_rows(df, productivity_years)
+    validation = {}
+    if validation_checks:
+        df, validation = validate_frame(df, validation_checks)
+    df = process_frame(cast_climate_types(df), COLUMNS_TO_KEEP, productivity_years)
+    return df, validation, time.process_time() - start_time
+
+
+def process_csv_parallel(source, productivity_years, workers, validation_checks=None):
+    """
+    Read, validate and process the climate CSV file with several worker processes.
+
+    The file is split into byte ranges of whole lines, one per worker; each
+    worker parses, validates and processes its own range (see process_csv_range),
+    so the parsing runs in parallel too and no raw rows are sent between
+    processes. The results are concatenated in the order of the file, giving
+    the same DataFrame as the serial pipeline.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - productivity_years (list): List of years considered as productivity years.
+    - workers (int): Number of worker processes.
+    - validation_checks (dict): Checks applied to the rows (see validate_data). If None, no check is applied.
+
+    Returns:
+    - pd.DataFrame: The processed DataFrame.
+    - dict: Violation counts by column and check.
+    """
+    start = time.perf_counter()
+    names = read_csv_header(source)
+    with open_binary_source(source) as file:
+        header_end = len(file.readline())
+    bounds = np.linspace(header_end, source_size(source), workers + 1, dtype=np.int64)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_csv_range, source, int(begin), int(end), names, productivity_years,
+                                   validation_checks)
+                   for begin, end in zip(bounds[:-1], bounds[1:])]
+        results = [future.result() for future in futures]
+    frames = [df for df, _, _ in results if df is not None]
+    df = pd.concat(frames, ignore_index=True)
+    validation = {}
+    for _, range_validation, _ in results:
+        merge_validation_reports(validation, range_validation)
+    elapsed = time.perf_counter() - start
+    busy = sum(cpu_time for _, _, cpu_time in results)
+    # The speedup over the serial pipeline is measured by benchmark.py
+    print(f"Read and processed {len(frames)} byte ranges with {workers} workers in {elapsed:.2f} s "
+          f"({busy:.2f} s of CPU time in the workers).")
+    return df, validation
+
+
+def parse_float_categories(series):
+    """
+    Parse a categorical column of numbers written as text with the pandas CSV parser.
+
+    The pandas CSV parser may differ from a correctly rounded one in the last
+    bit of a float64, so the coordinates and the measurements are parsed by
+    pandas to give exactly the same values as the pandas engine. Only the
+    distinct values are parsed. If some of them are not numbers, the text is
+    kept, as the pandas parser does, and the validator converts it.
+
+    Args:
+    - series (pd.Series): Categorical column of numbers written as text.
+
+    Returns:
+    - np.ndarray: The float64 values, NaN for missing values, or the text of
+      the values if some of them are not numbers.
+    """
+    categories = series.cat.categories
+    try:
+        parsed = pd.read_csv(io.StringIO('\n'.join(categories)), header=None, dtype='float64')[0].to_numpy() \
+            if len(categories) else np.empty(0)
+    except ValueError:
+        return series.to_numpy(dtype=object)
+    # The code of a missing value is -1, which picks the trailing NaN
+    return np.append(parsed, np.nan)[series.cat.codes.to_numpy()]
+
+
+def climate_query(source, dtypes, columns_to_keep, productivity_years):
+    """
+    Build the lazy Polars query reading and processing the climate CSV file.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - dtypes (dict): Type of the columns parsed by Polars, CLIMATE_DTYPES or CLIMATE_LENIENT_DTYPES.
+      The other columns are kept as text, to be parsed by pandas.
+    - columns_to_keep (list): List of columns to keep in the DataFrame.
+    - productivity_years (list): List of years considered as productivity years.
+
+    Returns:
+    - pl.LazyFrame: The query.
+    - list: The columns kept as text, as categories.
+    """
+    # Same column order as the pandas engine: the columns of the file, then the date columns
+    columns = [column for column in read_csv_header(source) if column in CLIMATE_USECOLS]
+    polars_types = {'int32': pl.Int32, 'float32': pl.Float32}
+    schema = {column: polars_types[dtype] for column, dtype in dtypes.items()}
+    # The coordinates are parsed by pandas afterwards, they are kept as categories meanwhile
+    text_columns = [column for column in columns if column not in dtypes]
+    schema.update({column: pl.String for column in text_columns})
+    if isinstance(source, tuple):
+        # Polars can not scan a member of a .zip archive, it is read in memory first
+        with open_csv_source(source) as file:
+            frame = pl.read_csv(file, columns=columns, schema_overrides=schema).lazy()
+    else:
+        frame = pl.scan_csv(source, schema_overrides=schema).select(columns)
+
+    year = pl.col('data') // 10000
+    month = pl.col('data') // 100 % 100
+    day = pl.col('data') % 100
+    month_offsets = {number + 1: int(offset) for number, offset in enumerate(MONTH_OFFSETS)}
+    season_of_day = {ordinal: season for ordinal, season in enumerate(SEASON_LOOKUP)}
+    ordinal = pl.col('month').replace_strict(month_offsets, default=None, return_dtype=pl.Int64) + pl.col('day') - 1
+    valid = pl.col('month').is_between(1, 12) & pl.col('day').is_between(1, 31)
+    query = (
+        frame
+        .filter(year.is_in([int(year) for year in productivity_years]))
+        .with_columns(year.cast(pl.Int16).alias('year'),
+                      month.cast(pl.Int8).alias('month'),
+                      day.cast(pl.Int8).alias('day'))
+        .select([column for column in columns + ['year', 'month', 'day'] if column in columns_to_keep])
+        .with_columns(pl.col(text_columns).cast(pl.Categorical),
+                      pl.when(valid)
+                      .then(ordinal.replace_strict(season_of_day, default='Unknown', return_dtype=pl.String))
+                      .otherwise(pl.lit('Unknown'))
+                      .alias('season'))
+    )
+    return query, text_columns
+
+
+def process_csv_lazy(source, columns_to_keep, productivity_years):
+    """
+    Read and process the climate CSV file as a single lazy Polars query.
+
+    The query expresses the same steps as process_frame: only the needed
+    columns are parsed, the rows of the other years are dropped while the
+    file is scanned, and the plan runs on all the cores. The result is the
+    same DataFrame as the one of the pandas engine. If some measurements are
+    not numbers, the file is read again with the measurements parsed
+    leniently (see CLIMATE_LENIENT_DTYPES), and the validator converts them.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - columns_to_keep (list): List of columns to keep in the DataFrame.
+    - productivity_years (list): List of years considered as productivity years.
+
+    Returns:
+    - pd.DataFrame: The processed DataFrame.
+    """
+    start = time.perf_counter()
+    try:
+        query, text_columns = climate_query(source, CLIMATE_DTYPES, columns_to_keep, productivity_years)
+        frame = query.collect()
+    except pl.exceptions.ComputeError:
+        # A key column which can not be parsed fails again, the error is raised
+        print('Some values of the climate file are not numbers, it is read again leniently.')
+        query, text_columns = climate_query(source, CLIMATE_LENIENT_DTYPES, columns_to_keep, productivity_years)
+        frame = query.collect()
+    df = frame.to_pandas()
+    for column in text_columns:
+        df[column] = parse_float_categories(df[column])
+    # Same string type as the labels assigned by assign_seasons
+    df['season'] = df['season'].to_numpy(dtype=object)
+    print(f"Processed {len(df)} rows with the polars engine in {time.perf_counter() - start:.2f} s.")
+    return df
+
+
+def estimate_chunksize(source, memory_budget_mb, sample_rows=10000):
+    """
+    Estimate how many CSV rows can be processed at once within a memory budget.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - memory_budget_mb (float): Memory available for one chunk, in megabytes.
+    - sample_rows (int): Number of rows read to measure the size of a row.
+
+    Returns:
+    - int: Number of rows of each chunk.
+    """
+    try:
+        sample = read_csv_source(source, nrows=sample_rows, usecols=CLIMATE_USECOLS, dtype=CLIMATE_DTYPES)
+    except ValueError:
+        sample = read_csv_source(source, nrows=sample_rows, usecols=CLIMATE_USECOLS, dtype=CLIMATE_LENIENT_DTYPES)
+    bytes_per_row = sample.memory_usage(deep=True).sum() / max(len(sample), 1)
+    chunksize = int(memory_budget_mb * 2**20 / (bytes_per_row * PROCESSING_OVERHEAD))
+    return max(chunksize, 1000)
+
+
+def cast_climate_types(df):
+    """
+    Give the measurements parsed leniently their types of CLIMATE_DTYPES.
+
+    The values which are not numbers must have been converted by the validator.
+
+    Args:
+    - df (pd.DataFrame): The validated climate DataFrame, raw or processed.
+
+    Returns:
+    - pd.DataFrame: The DataFrame with the types of CLIMATE_DTYPES.
+    """
+    types = {column: dtype for column, dtype in CLIMATE_DTYPES.items()
+             if column in df.columns and df[column].dtype != dtype}
+    return df.astype(types) if types else df
+
+
+def iter_processed_chunks(source, productivity_years, chunksize, validation_checks=None, validation=None,
+                          run_report=None):
+    """
+    Read the climate CSV file chunk by chunk, validate and process each chunk.
+
+    Args:
+    - source (str or tuple): Source of the climate CSV file.
+    - productivity_years (list): List of years considered as productivity years.
+    - chunksize (int): Number of rows of each chunk.
+    - validation_checks (dict): Checks applied to each chunk (see validate_data). If None, no check is applied.
+    - validation (dict): If given, updated in place with the violation counts of the chunks.
+    - run_report (dict): If given, each step is measured in this run report, summed over the chunks.
+
+    Yields:
+    - pd.DataFrame: The processed chunks.
+    """
+    reader = iter_climate_chunks(source, chunksize, CLIMATE_USECOLS, CLIMATE_DTYPES)
+    while True:
+        with measure_stage(run_report, 'read_csv') as measures:
+            try:
+                chunk = next(reader, None)
+            except ValueError as e:
+                print(f"Error: {e}. A key column of the climate file can not be parsed.")
+                raise
+            measures['rows_out'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            break
+        # Drop the rows of the other years before processing the chunk
+        chunk = run_stage(run_report, 'filter_raw_rows', filter_raw_rows, chunk, productivity_years)
+        if validation_checks:
+            with measure_stage(run_report, 'validate', rows_in=len(chunk)) as measures:
+                chunk, chunk_validation = validate_frame(chunk, validation_checks)
+                measures['rows_out'] = len(chunk)
+            if validation is not None:
+                merge_validation_reports(validation, chunk_validation)
+        chunk = cast_climate_types(chunk)
+        yield process_frame(chunk, COLUMNS_TO_KEEP, productivity_years, run_report)
+
+
+def partition_keys(year_month, codigo_ibge):
+    """
+    Return the key of the (year, month, station) partition of each climate row.
+
+    Args:
+    - year_month (array-like): Year and month of each row, as yyyymm.
+    - codigo_ibge (array-like): Code of the station of each row.
+
+    Returns:
+    - np.ndarray: The keys, yyyymm followed by the 7 digits of the code.
+    """
+    return np.asarray(year_month, dtype=np.int64) * STATION_KEY_FACTOR + np.asarray(codigo_ibge, dtype=np.int64)
+
+
+def hash_partitions(df):
+    """
+    Hash the (year, month, station) partitions of the parsed climate rows.
+
+    The hash of a partition covers every parsed column of its rows in the
+    order of the file, so it changes when a row of the partition is added,
+    removed, modified or moved. Each row is hashed with its rank in the
+    partition and the hashes of the rows are summed, without a loop over the partitions.
+
+    Args:
+    - df (pd.DataFrame): The validated raw climate DataFrame, with the 'data' and 'codigo_ibge' columns.
+
+    Returns:
+    - pd.DataFrame: One row per partition, with its key ('partition', see partition_keys),
+      its number of rows ('rows') and its hash ('hash').
+    """
+    if df.empty:
+        return pd.DataFrame({'partition': np.array([], dtype=np.int64), 'rows': np.array([], dtype=np.int64),
+                             'hash': np.array([], dtype=np.uint64)})
+    keys = partition_keys(df['data'].to_numpy() // 100, df['codigo_ibge'])
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    rows = np.diff(np.r_[starts, len(keys)])
+    ranks = np.arange(len(keys), dtype=np.uint64) - np.repeat(starts, rows).astype(np.uint64)
+    row_hashes = pd.util.hash_pandas_object(df.iloc[order], index=False).to_numpy()
+    row_hashes = pd.util.hash_array(row_hashes ^ pd.util.hash_array(ranks))
+    # The sums wrap around 2**64
+    return pd.DataFrame({'partition': keys[starts], 'rows': rows.astype(np.int64),
+                         'hash': np.add.reduceat(row_hashes, starts)})
+
+
+def refresh_subfile(df, productivity_years, cached_df, cached_hashes, hashes, run_report=None):
+    """
+    Refresh the processed DataFrame of the previous version of the climate file.
+
+    Only the rows of the (year, month, station) partitions that are new or
+    whose hash changed are processed, the rows of the other partitions are
+    taken from the cached DataFrame. The rows are then put back in the order
+    of the file, so the result is the DataFrame a full rebuild would give.
+
+    Args:
+    - df (pd.DataFrame): The validated raw climate rows of the new version.
+    - productivity_years (list): List of years considered as productivity years.
+    - cached_df (pd.DataFrame): The processed DataFrame of the previous version.
+    - cached_hashes (pd.DataFrame): The hashes of the partitions of the previous version.
+    - hashes (pd.DataFrame): The hashes of the partitions of the new version (see hash_partitions).
+    - run_report (dict): If given, each step is measured in this run report.
+
+    Returns:
+    - pd.DataFrame: The processed DataFrame of the new version.
+    """
+    # A partition is unchanged when it has the same number of rows and the same hash
+    unchanged = hashes.merge(cached_hashes, on=['partition', 'rows', 'hash'])['partition'].to_numpy()
+    keys = partition_keys(df['data'].to_numpy() // 100, df['codigo_ibge'])
+    reused = np.isin(keys, unchanged)
+    cached_keys = partition_keys(cached_df['year'].to_numpy(np.int64) * 100 + cached_df['month'].to_numpy(np.int64),
+                                 cached_df['codigo_ibge'])
+    kept = np.isin(cached_keys, unchanged)
+    if kept.sum() != reused.sum():
+        print("Error: the cached rows do not match the unchanged partitions. The data is processed again.")
+        return process_frame(df, COLUMNS_TO_KEEP, productivity_years, run_report)
+    print(f"Processing {len(hashes) - len(unchanged)} of {len(hashes)} partitions (year, month, station), "
+          "the others are unchanged.")
+    processed = process_frame(df[~reused], COLUMNS_TO_KEEP, productivity_years, run_report)
+    with measure_stage(run_report, 'merge_partitions', rows_in=len(df)) as measures:
+        # The rows of an unchanged partition are in the same order in the cache and in the file
+        cached_order = np.flatnonzero(kept)[np.argsort(cached_keys[kept], kind='stable')]
+        file_order = np.flatnonzero(reused)[np.argsort(keys[reused], kind='stable')]
+        positions = np.concatenate([file_order, np.flatnonzero(~reused)])
+        # An empty frame would change the types of the cached columns
+        frames = [cached_df.take(cached_order)] + ([processed[cached_df.columns]] if len(processed) else [])
+        df = pd.concat(frames, ignore_index=True)
+        df = df.take(np.argsort(positions, kind='stable')).reset_index(drop=True)
+        measures['rows_out'] = len(df)
+    return df
+
+
+def iter_row_slices(df, rows):
+    """
+    Split a DataFrame into consecutive slices of rows, without copying it.
+
+    Args:
+    - df (pd.DataFrame): The DataFrame.
+    - rows (int): Number of rows of each slice.
+
+    Yields:
+    - pd.DataFrame: The slices, in the order of the rows.
+    """
+    for start in range(0, len(df), rows):
+        yield df.iloc[start:start + rows]
+
+
+def region_split(chunks):
+    """
+    Find the middle of the latitude and longitude ranges of the data.
+
+    Args:
+    - chunks (iterable): DataFrames with 'latitude' and 'longitude' columns, e.g. the
+      slices of the processed DataFrame.
+
+    Returns:
+    - tuple: The middle latitude and the middle longitude.
+    """
+    extremes = np.array([[chunk['latitude'].min(), chunk['latitude'].max(),
+                          chunk['longitude'].min(), chunk['longitude'].max()] for chunk in chunks if not chunk.empty])
+    if not len(extremes):
+        return np.nan, np.nan
+    return ((np.nanmax(extremes[:, 1]) + np.nanmin(extremes[:, 0])) / 2,
+            (np.nanmax(extremes[:, 3]) + np.nanmin(extremes[:, 2])) / 2)
+
+
+def assign_regions(dataframe, split=None):
+    """
+    Assign the north/south and east/west region of each row from its coordinates.
+
+    The regions are split at the middle of the latitude and longitude ranges,
+    as in the histograms of the dashboard.
+
+    Args:
+    - dataframe (pd.DataFrame): The DataFrame with 'latitude' and 'longitude' columns.
+    - split (tuple): The middle latitude and longitude of the whole data (see region_split).
+      If None, they are computed from the DataFrame.
+
+    Returns:
+    - pd.DataFrame: The DataFrame with the 'ns_region' and 'ew_region' columns.
+    """
+    average_lat, average_long = region_split([dataframe]) if split is None else split
+    return dataframe.assign(
+        ns_region=np.where(dataframe['latitude'] <= average_lat, 'north', 'south'),
+        ew_region=np.where(dataframe['longitude'] >= average_long, 'east', 'west'),
+    )
+
+
+def partial_cube(chunk, variables, split):
+    """
+    Aggregate one chunk of the daily data into statistics that can be combined between chunks.
+
+    Args:
+    - chunk (pd.DataFrame): A chunk of the processed DataFrame.
+    - variables (list): The variables to aggregate.
+    - split (tuple): The middle latitude and longitude of the whole data (see region_split).
+
+    Returns:
+    - pd.DataFrame: Count, sum, min, max and sum of squared deviations from the
+      mean ('m2') of each variable, by (year, season, codigo_ibge, ns_region, ew_region).
+    """
+    # Only the keys and the variables are copied, the variables in double precision
+    data = assign_regions(chunk[['year', 'season', 'codigo_ibge', 'latitude', 'longitude']], split)
+    data = data.drop(columns=['latitude', 'longitude'])
+    for variable in variables:
+        data[variable] = chunk[variable].to_numpy(dtype=np.float64)
+    partial = data.groupby(CUBE_KEYS, observed=True, sort=False)[variables].agg(['count', 'sum', 'min', 'max', 'var'])
+    for variable in variables:
+        # A group with a single value has no variance, its squared deviations sum to 0
+        partial[(variable, 'm2')] = (partial[(variable, 'var')] * (partial[(variable, 'count')] - 1)).fillna(0.0)
+    return partial.drop(columns=[(variable, 'var') for variable in variables])
+
+
+def combine_partial_cubes(partials, variables):
+    """
+    Combine the partial cubes of the chunks into the aggregate cube.
+
+    Counts, sums and extremes are combined directly. The squared deviations
+    are combined with the deviations of the chunk means from the overall
+    mean, which keeps the standard deviation accurate.
+
+    Args:
+    - partials (list): The partial cubes, as returned by partial_cube.
+    - variables (list): The aggregated variables.
+
+    Returns:
+    - pd.DataFrame: One row per (year, season, codigo_ibge, ns_region, ew_region).
+    """
+    columns = [f'{variable}_{statistic}' for variable in variables for statistic in CUBE_STATISTICS]
+    if not partials:
+        return pd.DataFrame(columns=CUBE_KEYS + columns)
+    combined = pd.concat(partials)
+    cube = {}
+    for variable in variables:
+        count, total = combined[(variable, 'count')], combined[(variable, 'sum')]
+        counts = count.groupby(level=CUBE_KEYS, observed=True).sum()
+        sums = total.groupby(level=CUBE_KEYS, observed=True).sum()
+        mean = (sums / counts).reindex(combined.index)
+        # Chunks without values of the variable do not contribute to the deviations
+        deviation = (count * (total / count - mean) ** 2).where(count > 0, 0.0)
+        m2 = (combined[(variable, 'm2')] + deviation).groupby(level=CUBE_KEYS, observed=True).sum()
+        cube[f'{variable}_mean'] = sums / counts.where(counts > 0)
+        cube[f'{variable}_min'] = combined[(variable, 'min')].groupby(level=CUBE_KEYS, observed=True).min()
+        cube[f'{variable}_max'] = combined[(variable, 'max')].groupby(level=CUBE_KEYS, observed=True).max()
+        cube[f'{variable}_std'] = np.sqrt(m2 / (counts - 1).where(counts > 1))
+        cube[f'{variable}_count'] = counts
+        cube[f'{variable}_sum'] = sums
+    return pd.DataFrame(cube)[columns].reset_index()
+
+
+def build_aggregate_cube(df, variables, chunk_rows=CUBE_CHUNK_ROWS):
+    """
+    Aggregate the daily data by year, season, municipality and region.
+
+    Each variable gets one column per statistic, e.g. 'TS_mean' or 'TS_count'.
+    The sums and counts allow computing exact means over any coarser grouping,
+    e.g. by year and season. The DataFrame is aggregated in slices of rows,
+    so only one slice is copied at a time.
+
+    Args:
+    - df (pd.DataFrame): The processed DataFrame.
+    - variables (list): The variables to aggregate.
+    - chunk_rows (int): Number of rows aggregated at once.
+
+    Returns:
+    - pd.DataFrame: One row per (year, season, codigo_ibge, ns_region, ew_region).
+    """
+    return build_aggregate_cube_from_chunks(lambda: iter_row_slices(df, chunk_rows), variables)
+
+
+def build_aggregate_cube_from_chunks(read_chunks, variables):
+    """
+    Aggregate the daily data read chunk by chunk, e.g. from the columnar cache.
+
+    The chunks are read twice: once to find the middle of the coordinate
+    ranges splitting the regions, once to aggregate them.
+
+    Args:
+    - read_chunks (callable): Function without arguments returning an iterable of
+      the chunks of the processed DataFrame.
+    - variables (list): The variables to aggregate.
+
+    Returns:
+    - pd.DataFrame: One row per (year, season, codigo_ibge, ns_region, ew_region).
+    """
+    split = region_split(read_chunks())
+    partials = [partial_cube(chunk, variables, split) for chunk in read_chunks() if not chunk.empty]
+    return combine_partial_cubes(partials, variables)
+
+
+def compute_productivity_totals(df_soja, productivity_years):
+    """
+    Sum the productivity of all the municipalities for each year.
+
+    Args:
+    - df_soja (pd.DataFrame): The productivity DataFrame.
+    - productivity_years (list): List of years considered as productivity years.
+
+    Returns:
+    - dict: Total productivity of each year (int).
+    """
+    return {int(year): float(df_soja[year].sum()) for year in productivity_years}
+
+
+def extract_aggregate_cube(read_chunks, df_soja, productivity_years, cube_key, output_folder, use_cache=True):
+    """
+    Make sure that the aggregate cube of the processed data is stored in the output folder.
+
+    Args:
+    - read_chunks (callable): Function without arguments returning an iterable of the
+      chunks of the processed DataFrame (see build_aggregate_cube_from_chunks).
+    - df_soja (pd.DataFrame): The productivity DataFrame.
+    - productivity_years (list): List of years considered as productivity years.
+    - cube_key (str): The key of the inputs the cube is computed from.
+    - output_folder (str): The directory where the cube is stored.
+    - use_cache (bool): Whether to keep the stored cube when its key matches.
+    """
+    # Only the schema of the stored cube is read to compare its key
+    if use_cache and read_aggregate_cube_key(output_folder) == cube_key \
+            and read_aggregate_cube_metadata(output_folder).get('key') == cube_key:
+        return
+    cube = build_aggregate_cube_from_chunks(read_chunks, CLIMATE_VARIABLES)
+    save_aggregate_cube(cube, compute_productivity_totals(df_soja, productivity_years), output_folder, cube_key)
+    print(f'Aggregate cube written with {len(cube)} rows.')
+
+
+def compact_frame(df, max_category_ratio=0.5):
+    """
+    Convert the DataFrame to a compact in-memory representation.
+
+    Integer columns are downcast to the smallest type holding their values
+    (e.g. int16, int8). Floating point columns are downcast to float32 only
+    when no value changes: the coordinates, which are the keys of the map
+    markers, keep their float64 values. String columns with
+    few distinct values become categoricals, the others Arrow-backed strings.
+    The memory used by each column before and after is reported.
+
+    Args:
+    - df (pd.DataFrame): The processed DataFrame.
+    - max_category_ratio (float): Maximum ratio of distinct values to rows
+      for a string column to become a categorical.
+
+    Returns:
+    - pd.DataFrame: The compact DataFrame, with the same columns and values.
+    """
+    compact = {}
+    for column in df.columns:
+        series = df[column]
+        if pd.api.types.is_float_dtype(series.dtype):
+            downcast = pd.to_numeric(series, downcast='float')
+            # Keep the original type when the downcast would round some values
+            lossless = np.array_equal(downcast.to_numpy(dtype=np.float64), series.to_numpy(dtype=np.float64),
+                                      equal_nan=True)
+            compact[column] = downcast if lossless else series
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            compact[column] = pd.to_numeric(series, downcast='integer')
+        elif pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+            if series.nunique() <= max_category_ratio * len(series):
+                compact[column] = series.astype('category')
+            else:
+                compact[column] = series.astype('string[pyarrow]')
+        else:
+            compact[column] = series
+    compact_df = pd.DataFrame(compact, index=df.index)
+
+    # Memory report, in MB
+    report = pd.DataFrame({
+        'dtype before': df.dtypes.astype(str),
+        'MB before': df.memory_usage(deep=True, index=False) / 2**20,
+        'dtype after': compact_df.dtypes.astype(str),
+        'MB after': compact_df.memory_usage(deep=True, index=False) / 2**20,
+    })
+    print(report.round(2))
+    before, after = report['MB before'].sum(), report['MB after'].sum()
+    print(f"Compact frame: {before:.1f} MB -> {after:.1f} MB ({after / max(before, 1e-9):.0%}).")
+    return compact_df
+
+
+def extract_subfile(input_folder, output_folder, use_cache=True, memory_budget_mb=None, incremental=False,
+                    workers=None, partitioned=False, engine='pandas', validation_checks=VALIDATION_CHECKS,
+                    run_summary=False, trace_memory=False):
+    """
+    Extract and process data, caching the result in an output folder.
+
+    The processed DataFrame is stored as a Parquet file together with a key
+    built from the input files and the pipeline parameters: when the key
+    matches, the cached DataFrame is loaded instead of processing the data again.
+
+    With a memory budget the climate CSV file is streamed: it is read in chunks
+    sized to fit the budget, and each processed chunk is appended to the cache,
+    so the raw data never has to fit in memory at once. The partitioned store
+    and the aggregate cube are then built from the cache one chunk at a time.
+    The returned DataFrame is loaded from the cache at the end: it holds all
+    the processed rows and is not covered by the budget.
+
+    In incremental mode the climate file is parsed and validated, and its rows
+    are hashed by (year, month, station) partition: only the partitions that
+    are new or changed since the cache was written are processed, the others
+    are taken from the cache (see refresh_subfile). It applies to files inside
+    archives as well, and the file is read by pandas in the main process.
+
+    Args:
+    - input_folder (str): The directory path containing input CSV files or .zip archives.
+    - output_folder (str): The directory path to save the processed data.
+    - use_cache (bool): Whether to load the columnar cache when it is up to date.
+    - memory_budget_mb (float): Memory budget of the streaming mode, in megabytes.
+      If None, the whole CSV file is processed in memory.
+    - incremental (bool): Whether to refresh the cache by processing only the changed partitions.
+      It applies when the data is processed in memory, without a memory budget.
+    - workers (int): Number of worker processes used to process the data in memory.
+      If None or 1, the data is processed in the main process.
+    - partitioned (bool): Whether to write also a store partitioned by year and month,
+      which can be loaded one partition at a time (see store_data.make_partition_loader).
+    - engine (str): Engine processing the data in memory, 'pandas' or 'polars'
+      (see process_csv_lazy). Both give the same DataFrame.
+    - validation_checks (dict): Checks applied to the climate data before it is processed
+      (see validate_data.VALIDATION_CHECKS). If None, the data is not validated.
+    - run_summary (bool): Whether to print a summary of the run report. The report,
+      with the times, rows and peak memory of each stage, is always written
+      to the output folder (see run_report).
+    - trace_memory (bool): Whether to measure the peak memory of each stage. It slows down the run.
+
+    Returns:
+    - pd.DataFrame: The processed DataFrame. With a memory budget it is loaded
+      after the other stages, and it does not fit the budget.
+    - pd.DataFrame: Secondary DataFrame for additional processing.
+    - str: The key of the aggregate cube of the processed data (see store_data.load_aggregate_cube).
+    """
+    if engine not in ENGINES:
+        print(f"Error: unknown engine '{engine}'. The pandas engine is used.")
+        engine = 'pandas'
+    elif engine == 'polars' and pl is None:
+        print("Error: polars is not installed. The pandas engine is used.")
+        engine = 'pandas'
+
+    # Find the primary and secondary CSV files
+    df_source, df_soja_source = find_csv_files(input_folder)
+    if df_source is None:
+        return None, None, None
+    # Define the year range for filtering the DataFrame from the header of the secondary file
+    productivity_years = read_csv_header(df_soja_source)[3:]  # Seleziona solo le colonne degli anni
     print(productivity_years)
-    # year_values = [col for col in selected_years]  # Ottieni le stringhe degli anni
 
-    # Filter the primary DataFrame based on the year range
-    df = filter_rows(df, productivity_years)
+    # Look for a cached result computed from the same inputs and parameters
+    parameters = {
+        'columns_to_keep': COLUMNS_TO_KEEP,
+        'productivity_years': list(productivity_years),
+        'seasons': SEASONS,
+        'validation_checks': validation_checks,
+    }
+    # The processed data depends on the productivity file only through the productivity years
+    cache_key, fingerprints = compute_cache_key([df_source], parameters, output_folder)
+    # Key of the parameters only, it must match to refresh the cache partition by partition
+    base_key, _ = compute_cache_key([], parameters, output_folder)
+    # The aggregate cube also depends on the productivity file
+    cube_key, _ = compute_cache_key([df_soja_source], {'data_key': cache_key}, output_folder)
+    # Times, rows and peak memory of each stage, written to the output folder
+    run_report = new_run_report(trace_memory)
+    with measure_stage(run_report, 'load_cache') as measures:
+        df = load_cached_frame(output_folder, cache_key) if use_cache else None
+        measures['rows_out'] = None if df is None else len(df)
+    if df is not None:
+        print('Processed data loaded from the cache.')
+        df_soja = read_productivity_csv(df_soja_source)
 
-    # Assign 'season' column based on 'month', and 'day'
-    print(df)
-    df = assign_seasons(df)
-    
-    # Merge DataFrames to add the 'name_ibge' column
-    df = add_name_ibge(df, df_soja)
-    # Save the processed DataFrame to a CSV file
-    df.to_csv(output_file_path, index=False)
-    # Return the processed primary DataFrame and the secondary DataFrame
-    return df, df_soja
+    elif memory_budget_mb:
+        df_soja = read_productivity_csv(df_soja_source)
+        # Stream the primary CSV file into the cache, then load the processed data
+        try:
+            chunksize = estimate_chunksize(df_source, memory_budget_mb)
+        except ValueError as e:
+            print(f"Error: {e}. A key column of the climate file can not be parsed.")
+            return None, df_soja, cube_key
+        print(f'Streaming the data in chunks of {chunksize} rows.')
+        validation = {}
+        chunks = iter_processed_chunks(df_source, productivity_years, chunksize, validation_checks, validation,
+                                       run_report)
+        rows = save_cached_chunks(chunks, output_folder, cache_key, fingerprints, run_report,
+                                  base_key=base_key, validation=validation)
+        if rows is None:
+            return None, df_soja, cube_key
+        print_validation_report(validation)
+        # The next stages read the cache one row group, i.e. one chunk, at a time
+        read_chunks = lambda: iter_cached_chunks(output_folder, cache_key)
+
+    else:
+        cached_df = cached_hashes = None
+        if use_cache and incremental:
+            with measure_stage(run_report, 'load_refreshable_cache') as measures:
+                cached_df, cached_hashes = load_refreshable_frame(output_folder, base_key)
+                measures['rows_out'] = None if cached_df is None else len(cached_df)
+        # The incremental mode hashes the raw rows, so it reads them with pandas in the main process
+        polars_query = engine == 'polars' and not incremental
+        # Worker processes pay off only for a large enough file
+        parallel = engine == 'pandas' and not incremental and bool(workers) and workers > 1
+        if parallel and source_size(df_source) < PARALLEL_MIN_BYTES:
+            print('The climate file is too small for worker processes, it is processed in the main process.')
+            parallel = False
+        df_soja = None
+        validation = {}
+        try:
+            if polars_query:
+                # Read and process the primary CSV file in a single lazy query
+                df_soja = read_productivity_csv(df_soja_source)
+                with measure_stage(run_report, 'polars_query') as measures:
+                    df = process_csv_lazy(df_source, COLUMNS_TO_KEEP, productivity_years)
+                    measures['rows_out'] = len(df)
+            elif parallel:
+                # Each worker reads, validates and processes its own part of the file
+                df_soja = read_productivity_csv(df_soja_source)
+                with measure_stage(run_report, 'parallel_read_process') as measures:
+                    df, validation = process_csv_parallel(df_source, productivity_years, workers, validation_checks)
+                    measures['rows_out'] = len(df)
+            else:
+                # Read the primary and secondary CSV files
+                with measure_stage(run_report, 'read_csv') as measures:
+                    df, df_soja = read_csv_files(df_source, df_soja_source, CLIMATE_USECOLS, CLIMATE_DTYPES,
+                                                 productivity_years)
+                    measures['rows_out'] = len(df)
+        except PARSE_ERRORS as e:
+            print(f"Error: {e}. A key column of the climate file can not be parsed.")
+            return None, df_soja, cube_key
+        # The checks apply to the processed columns of the polars engine as well as to the raw ones
+        if validation_checks and not parallel:
+            with measure_stage(run_report, 'validate', rows_in=len(df)) as measures:
+                df, validation = validate_frame(df, validation_checks)
+                measures['rows_out'] = len(df)
+        df = cast_climate_types(df)
+        hashes = None
+        if incremental:
+            with measure_stage(run_report, 'hash_partitions', rows_in=len(df)):
+                hashes = hash_partitions(df)
+        if cached_df is not None:
+            print('Refreshing the cached data with the changed partitions of the climate file.')
+            df = refresh_subfile(df, productivity_years, cached_df, cached_hashes, hashes, run_report)
+        elif not polars_query and not parallel:
+            # Process the primary DataFrame
+            df = process_frame(df, COLUMNS_TO_KEEP, productivity_years, run_report)
+        print_validation_report(validation)
+        print(f'Processed {len(df)} rows.')
+        # Save the processed DataFrame in the columnar cache
+        with measure_stage(run_report, 'write_cache', rows_in=len(df)):
+            save_cached_frame(df, output_folder, cache_key, fingerprints, base_key=base_key, validation=validation)
+            if hashes is not None:
+                save_partition_hashes(hashes, output_folder, cache_key)
+
+    if df is not None:
+        rows = len(df)
+        read_chunks = lambda: iter_row_slices(df, CUBE_CHUNK_ROWS)
+    # Write the year/month partitioned store if it is not up to date
+    if partitioned and read_partitioned_metadata(output_folder).get('key') != cache_key:
+        with measure_stage(run_report, 'write_partitioned_store', rows_in=rows):
+            write_partitioned_store(read_chunks(), output_folder, cache_key)
+    # Write the aggregate cube if it is not up to date
+    if rows:
+        with measure_stage(run_report, 'aggregate_cube', rows_in=rows):
+            extract_aggregate_cube(read_chunks, df_soja, productivity_years, cube_key, output_folder, use_cache)
+    if df is None:
+        # The processed data streamed to the cache is loaded last
+        with measure_stage(run_report, 'load_cache') as measures:
+            df = load_cached_frame(output_folder, cache_key)
+            if df is None:
+                df = pd.DataFrame()
+            measures['rows_out'] = len(df)
+
+    finish_run_report(run_report, rows=len(df), cache_key=cache_key, options={
+        'use_cache': use_cache, 'memory_budget_mb': memory_budget_mb, 'incremental': incremental,
+        'workers': workers, 'partitioned': partitioned, 'engine': engine, 'trace_memory': trace_memory,
+    })
+    write_run_report(run_report, output_folder)
+    if run_summary:
+        print_run_report(run_report)
+
+    # Return the processed primary DataFrame, the secondary DataFrame and the key of the aggregate cube
+    return df, df_soja, cube_key
@@ -1,8 +1,9 @@
 import os
 import dash
 from download_data import dataset_check_download
-from elaborate_2 import extract_subfile
+from elaborate_2 import extract_subfile, compact_frame
 from dash_tot import create_dash
+from store_data import load_aggregate_cube
 
 
 
@@ -51,6 +52,73 @@ def read_config():
 
     return driver_path, binary_location
 
+
+def parse_config_value(value):
+    """
+    Convert a value read from the pipeline configuration file.
+
+    Args:
+    - value (str): The value as written in the file.
+
+    Returns:
+    - The value converted to None, bool, int or float when possible, else the string.
+    """
+    if value.lower() in ('none', ''):
+        return None
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def read_pipeline_config(file_path="pipeline_config.txt"):
+    """
+    Read the options of the processing pipeline.
+
+    Each line of the file has the form 'option = value', lines starting
+    with '#' are comments. Missing options keep their default value.
+
+    Args:
+    - file_path (str): Path of the pipeline configuration file.
+
+    Returns:
+    - dict: Options of the processing pipeline.
+    """
+    options = {
+        'use_cache': True,
+        'memory_budget_mb': None,
+        'incremental': False,
+        'workers': None,
+        'partitioned': False,
+        'compact': True,
+        'engine': 'pandas',
+        'run_summary': True,
+        'trace_memory': False,
+        'map_cache_mb': 64,
+        'map_cache_on_disk': True,
+        'map_mode': 'folium',
+        'color_scale': 'linear',
+    }
+    try:
+        with open(file_path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                option, value = (part.strip() for part in line.split('=', 1))
+                if option in options:
+                    options[option] = parse_config_value(value)
+                else:
+                    print(f"Unknown pipeline option '{option}' ignored.")
+    except FileNotFoundError:
+        print('No pipeline configuration found, using the default options.')
+
+    return options
+
 def main():
     print('start')
     # Create the workspace
@@ -71,13 +139,36 @@ def main():
     
     # Look for the dataset: it is dowloaded, it is updated, eventually download it
     # dataset_check_download(url, input_folder_path, output_folder_path, driver_path, binary_location)
+    # or, without a browser, using the Kaggle API credentials:
+    # dataset_check_download(url, input_folder_path, output_folder_path, method='http')
+
+    # Read the options of the processing pipeline in file pipeline_config.txt
+    pipeline_options = read_pipeline_config()
+    compact = pipeline_options.pop('compact')
+    map_cache_mb = pipeline_options.pop('map_cache_mb')
+    map_cache_on_disk = pipeline_options.pop('map_cache_on_disk')
+    map_mode = pipeline_options.pop('map_mode')
+    color_scale = pipeline_options.pop('color_scale')
 
     # Adjust the dataset by extracting a subfile with interested information
-    df, df_soja = extract_subfile(input_folder_path, output_folder_path)
+    df, df_soja, cube_key = extract_subfile(input_folder_path, output_folder_path, **pipeline_options)
+
+    # Keep the frame shared by the dashboard in a compact representation
+    if compact and df is not None:
+        df = compact_frame(df)
 
     
+    # Aggregates precomputed by extract_subfile for the charts of the dashboard
+    # The key makes sure that a cube of older data is not loaded, e.g. when no cube was written
+    cube, productivity_totals = load_aggregate_cube(output_folder_path, cube_key)
+
+    # The rendered maps can be cached on disk, they depend on the data of the aggregate cube
+    map_cache_folder = os.path.join(output_folder_path, 'map_cache') if map_cache_on_disk else None
+    map_cache_namespace = f"{cube_key}-{'compact' if compact else 'full'}-{color_scale}"
+
     # Create a dashboard to visualize the resut
-    app = create_dash(df, df_soja)
+    app = create_dash(df, df_soja, cube, productivity_totals, map_cache_mb, map_cache_folder, map_cache_namespace,
+                      map_mode, color_scale)
     
     if __name__ == '__main__':
         app.run_server(debug=True, use_reloader = False)
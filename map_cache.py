@@ -0,0 +1,226 @@
+import os
+import hashlib
+import shutil
+import threading
+from collections import OrderedDict
+
+# Default size of the cache of the rendered maps, in megabytes
+MAP_CACHE_MB = 64
+
+# The disk copy of a cache can be larger than the cache in memory
+DISK_SIZE_RATIO = 8
+
+
+def new_lru_cache(max_bytes, folder=None, namespace=None):
+    """
+    Create a cache keeping the most recently used values within a size limit.
+
+    With a folder, the string values are also written to disk, so they
+    survive a restart of the application. The namespace identifies the data
+    the values were computed from: the entries of other namespaces are
+    deleted, since they belong to an older version of the data.
+
+    Args:
+    - max_bytes (int): Maximum total size of the values kept in memory.
+    - folder (str): The directory of the disk copy. If None, the cache is kept only in memory.
+    - namespace (str): Version of the data the values are computed from.
+
+    Returns:
+    - dict: The cache, used with lru_get, lru_put and lru_get_or_compute.
+    """
+    disk_bytes = 0
+    if folder is not None:
+        namespace = namespace or 'default'
+        os.makedirs(folder, exist_ok=True)
+        for entry in os.scandir(folder):
+            if entry.name == namespace:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        folder = os.path.join(folder, namespace)
+        os.makedirs(folder, exist_ok=True)
+        disk_bytes = sum(entry.stat().st_size for entry in os.scandir(folder))
+    return {
+        'entries': OrderedDict(),
+        'bytes': 0,
+        'max_bytes': max_bytes,
+        'folder': folder,
+        'disk_bytes': disk_bytes,
+        'max_disk_bytes': max_bytes * DISK_SIZE_RATIO,
+        'hits': 0,
+        'disk_hits': 0,
+        'misses': 0,
+        'evictions': 0,
+        'lock': threading.Lock(),
+    }
+
+
+def cache_file_path(cache, key):
+    """
+    Path of the disk copy of a cache entry.
+
+    Args:
+    - cache (dict): The cache.
+    - key (tuple): The key of the entry.
+
+    Returns:
+    - str: Path of the file of the entry.
+    """
+    return os.path.join(cache['folder'], hashlib.sha1(repr(key).encode()).hexdigest() + '.html')
+
+
+def store_in_memory(cache, key, value, size):
+    """
+    Store a value in memory, evicting the least recently used values beyond the size limit.
+
+    The cache lock must be held by the caller.
+
+    Args:
+    - cache (dict): The cache.
+    - key (tuple): The key of the value.
+    - value: The value.
+    - size (int): Size of the value, in bytes.
+    """
+    if size > cache['max_bytes']:
+        return
+    entries = cache['entries']
+    if key in entries:
+        cache['bytes'] -= entries.pop(key)[1]
+    entries[key] = (value, size)
+    cache['bytes'] += size
+    while cache['bytes'] > cache['max_bytes']:
+        _, (_, evicted_size) = entries.popitem(last=False)
+        cache['bytes'] -= evicted_size
+        cache['evictions'] += 1
+
+
+def lru_get(cache, key):
+    """
+    Look up a value in memory, then on disk.
+
+    Args:
+    - cache (dict): The cache.
+    - key (tuple): The key of the value.
+
+    Returns:
+    - The value, or None if it is not in the cache.
+    """
+    with cache['lock']:
+        if key in cache['entries']:
+            cache['entries'].move_to_end(key)
+            cache['hits'] += 1
+            return cache['entries'][key][0]
+    if cache['folder'] is not None:
+        path = cache_file_path(cache, key)
+        try:
+            with open(path, "r", encoding="utf-8") as file:
+                value = file.read()
+            # The modification time orders the files from the least recently used
+            os.utime(path)
+        except OSError:
+            value = None
+        if value is not None:
+            with cache['lock']:
+                cache['disk_hits'] += 1
+                store_in_memory(cache, key, value, len(value.encode()))
+            return value
+    with cache['lock']:
+        cache['misses'] += 1
+    return None
+
+
+def lru_put(cache, key, value, size):
+    """
+    Add a value to the cache, and to its disk copy if it has one.
+
+    Args:
+    - cache (dict): The cache.
+    - key (tuple): The key of the value.
+    - value: The value, a string if the cache has a disk copy.
+    - size (int): Size of the value, in bytes.
+    """
+    with cache['lock']:
+        store_in_memory(cache, key, value, size)
+    if cache['folder'] is None or not isinstance(value, str):
+        return
+    path = cache_file_path(cache, key)
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as file:
+            file.write(value)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Error: {e}. Failed to write the map to the disk cache.")
+        return
+    with cache['lock']:
+        cache['disk_bytes'] += os.path.getsize(path)
+        if cache['disk_bytes'] > cache['max_disk_bytes']:
+            evict_from_disk(cache)
+
+
+def evict_from_disk(cache):
+    """
+    Delete the least recently used files of the disk copy beyond its size limit.
+
+    The cache lock must be held by the caller.
+
+    Args:
+    - cache (dict): The cache.
+    """
+    files = sorted(os.scandir(cache['folder']), key=lambda entry: entry.stat().st_mtime)
+    cache['disk_bytes'] = sum(entry.stat().st_size for entry in files)
+    for entry in files:
+        if cache['disk_bytes'] <= cache['max_disk_bytes']:
+            break
+        size = entry.stat().st_size
+        try:
+            os.remove(entry.path)
+        except OSError:
+            continue
+        cache['disk_bytes'] -= size
+
+
+def lru_get_or_compute(cache, key, compute, sizeof=lambda value: len(value.encode())):
+    """
+    Return the cached value of a key, computing and caching it on a miss.
+
+    Args:
+    - cache (dict): The cache, or None to always compute the value.
+    - key (tuple): The key of the value.
+    - compute (callable): Function without arguments computing the value.
+    - sizeof (callable): Function giving the size of a value in bytes.
+
+    Returns:
+    - The value.
+    """
+    if cache is None:
+        return compute()
+    value = lru_get(cache, key)
+    if value is None:
+        value = compute()
+        if value is not None:
+            lru_put(cache, key, value, sizeof(value))
+    return value
+
+
+def lru_stats(cache):
+    """
+    Summarize the use of a cache.
+
+    Args:
+    - cache (dict): The cache.
+
+    Returns:
+    - dict: Number of hits (in memory and on disk), misses, evictions,
+      entries and megabytes in memory.
+    """
+    with cache['lock']:
+        return {
+            'hits': cache['hits'],
+            'disk_hits': cache['disk_hits'],
+            'misses': cache['misses'],
+            'evictions': cache['evictions'],
+            'entries': len(cache['entries']),
+            'memory_mb': round(cache['bytes'] / 2**20, 2),
+        }
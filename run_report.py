@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+RUN_REPORT_FILE = "run_report.json"
+
+
+def new_run_report(trace_memory=False):
+    """
+    Create an empty report of a pipeline run.
+
+    Args:
+    - trace_memory (bool): Whether to measure the peak memory of each stage with tracemalloc.
+      Tracing the allocations slows down the stages, up to several times for
+      the stages creating many Python objects, so it is off by default.
+
+    Returns:
+    - dict: The report, filled by measure_stage and run_stage.
+    """
+    # Memory is traced only during the run, unless it was already traced
+    stop_tracing = trace_memory and not tracemalloc.is_tracing()
+    if stop_tracing:
+        tracemalloc.start()
+    return {
+        'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'trace_memory': trace_memory,
+        'stop_tracing': stop_tracing,
+        'start_wall': time.perf_counter(),
+        'start_cpu': time.process_time(),
+        'stages': {},
+    }
+
+
+@contextmanager
+def measure_stage(report, name, rows_in=None):
+    """
+    Measure a stage of the pipeline: wall time, CPU time, rows and peak memory.
+
+    The caller sets the 'rows_out' item of the yielded dict. A stage run
+    several times, e.g. once per chunk, is accumulated: times and rows are
+    summed, the peak memory is the largest one. Stages must not be nested,
+    since each stage resets the peak of tracemalloc.
+
+    Args:
+    - report (dict): The run report, or None to measure nothing.
+    - name (str): Name of the stage.
+    - rows_in (int): Number of rows given to the stage.
+
+    Yields:
+    - dict: Measures of the stage, 'rows_out' is set by the caller.
+    """
+    measures = {'rows_in': rows_in, 'rows_out': None}
+    if report is None:
+        yield measures
+        return
+    if report['trace_memory']:
+        memory_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    try:
+        yield measures
+    finally:
+        stage = report['stages'].setdefault(name, {
+            'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'rows_in': None, 'rows_out': None, 'peak_memory_mb': None,
+        })
+        stage['calls'] += 1
+        stage['wall_s'] += time.perf_counter() - start_wall
+        stage['cpu_s'] += time.process_time() - start_cpu
+        for key in ('rows_in', 'rows_out'):
+            if measures[key] is not None:
+                stage[key] = (stage[key] or 0) + int(measures[key])
+        if report['trace_memory']:
+            # Peak memory allocated by the stage, on top of the memory in use when it started
+            peak = (tracemalloc.get_traced_memory()[1] - memory_before) / 2**20
+            stage['peak_memory_mb'] = max(stage['peak_memory_mb'] or 0.0, peak)
+
+
+def run_stage(report, name, function, df, *args, **kwargs):
+    """
+    Run a stage taking and returning a DataFrame, measuring it.
+
+    Args:
+    - report (dict): The run report, or None to measure nothing.
+    - name (str): Name of the stage.
+    - function (callable): The stage, called as function(df, *args, **kwargs).
+    - df (pd.DataFrame): The DataFrame given to the stage.
+
+    Returns:
+    - pd.DataFrame: The DataFrame returned by the stage.
+    """
+    with measure_stage(report, name, rows_in=len(df)) as measures:
+        df = function(df, *args, **kwargs)
+        measures['rows_out'] = len(df)
+    return df
+
+
+def finish_run_report(report, **extra):
+    """
+    Add the total times of the run to the report.
+
+    Args:
+    - report (dict): The run report.
+    - **extra: Other information about the run, e.g. the options of the pipeline.
+
+    Returns:
+    - dict: The report, ready to be written.
+    """
+    report['total_wall_s'] = time.perf_counter() - report.pop('start_wall')
+    report['total_cpu_s'] = time.process_time() - report.pop('start_cpu')
+    report.update(extra)
+    if report.pop('stop_tracing'):
+        tracemalloc.stop()
+    return report
+
+
+def write_run_report(report, output_folder):
+    """
+    Write the run report as JSON in the output folder.
+
+    Args:
+    - report (dict): The finished run report.
+    - output_folder (str): The directory where the report is written.
+    """
+    report_path = os.path.join(output_folder, RUN_REPORT_FILE)
+    try:
+        with open(report_path, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, default=str)
+    except OSError as e:
+        print(f"Error: {e}. Failed to write the run report.")
+
+
+def print_run_report(report):
+    """
+    Print a summary of the run report, one line per stage.
+
+    Args:
+    - report (dict): The finished run report.
+    """
+    table = pd.DataFrame(report['stages']).T
+    table = table.astype({'calls': 'Int64', 'rows_in': 'Int64', 'rows_out': 'Int64',
+                          'wall_s': 'float64', 'cpu_s': 'float64', 'peak_memory_mb': 'float64'})
+    print(table.to_string(float_format=lambda value: f'{value:.3f}'))
+    print(f"Total: {report['total_wall_s']:.3f} s wall, {report['total_cpu_s']:.3f} s CPU.")
@@ -0,0 +1,548 @@
+import os
+import json
+import hashlib
+import shutil
+import zipfile
+from functools import lru_cache
+import pandas as pd
+from run_report import measure_stage
+
+# Bump this whenever the layout of the processed DataFrame changes,
+# so that caches written by an older pipeline are rebuilt.
+CACHE_VERSION = 5
+
+CACHE_FILE = "filtered_data.parquet"
+CACHE_KEY_FILE = "filtered_data.json"
+PARTITION_HASHES_FILE = "partition_hashes.parquet"
+
+PARTITIONED_STORE = "partitioned_data"
+PARTITIONED_METADATA_FILE = "_metadata.json"
+
+AGGREGATE_CUBE_FILE = "aggregate_cube.parquet"
+AGGREGATE_CUBE_KEY_FILE = "aggregate_cube.json"
+
+
+def hash_file(path, block_size=1 << 20):
+    """
+    Compute a content hash of a file, reading it block by block.
+
+    Args:
+    - path (str): Path of the file to hash.
+    - block_size (int): Number of bytes read at each step.
+
+    Returns:
+    - str: Hexadecimal digest of the file content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(source, known_fingerprints=None):
+    """
+    Describe an input file by name, size, modification time and content hash.
+
+    The content hash is the expensive part, so it is reused from
+    known_fingerprints when size and modification time did not change.
+    For a file inside a .zip archive, the CRC stored in the archive is used
+    as content hash and the archive itself is never decompressed.
+
+    Args:
+    - source (str or tuple): Path of the file or (archive path, member name) tuple.
+    - known_fingerprints (list): Fingerprints stored by a previous run.
+
+    Returns:
+    - dict: Fingerprint of the file.
+    """
+    if isinstance(source, tuple):
+        archive_path, member = source
+        with zipfile.ZipFile(archive_path, 'r') as zip_ref:
+            info = zip_ref.getinfo(member)
+        return {
+            'name': member,
+            'size': info.file_size,
+            'mtime': list(info.date_time),
+            'hash': f'crc32:{info.CRC:08x}',
+        }
+    stat = os.stat(source)
+    fingerprint = {
+        'name': os.path.basename(source),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+    for known in known_fingerprints or []:
+        if all(known.get(key) == value for key, value in fingerprint.items()):
+            fingerprint['hash'] = known['hash']
+            return fingerprint
+    fingerprint['hash'] = hash_file(source)
+    return fingerprint
+
+
+def read_cache_metadata(output_folder):
+    """
+    Read the metadata saved next to the cached DataFrame.
+
+    Args:
+    - output_folder (str): The directory containing the cache.
+
+    Returns:
+    - dict: The stored metadata, empty if there is no cache.
+    """
+    key_path = os.path.join(output_folder, CACHE_KEY_FILE)
+    try:
+        with open(key_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_cache_metadata(output_folder, cache_key, fingerprints, **extra):
+    """
+    Save the cache key and the input fingerprints next to the cached DataFrame.
+
+    Args:
+    - output_folder (str): The directory containing the cache.
+    - cache_key (str): The key of the current inputs.
+    - fingerprints (list): Fingerprints of the input files.
+    - **extra: Other metadata to save, e.g. the violation counts of the validation.
+    """
+    key_path = os.path.join(output_folder, CACHE_KEY_FILE)
+    temp_path = key_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        json.dump({'key': cache_key, 'files': fingerprints, **extra}, file, indent=2)
+    os.replace(temp_path, key_path)
+
+
+def compute_cache_key(sources, parameters, output_folder):
+    """
+    Build the cache key from the input files and the pipeline parameters.
+
+    Args:
+    - sources (list): Paths of the input CSV files or (archive path, member name) tuples.
+    - parameters (dict): Parameters of the processing pipeline.
+    - output_folder (str): The directory containing the cache.
+
+    Returns:
+    - str: The cache key.
+    - list: Fingerprints of the input files.
+    """
+    known_fingerprints = read_cache_metadata(output_folder).get('files', [])
+    fingerprints = [file_fingerprint(source, known_fingerprints) for source in sorted(sources, key=str)]
+    payload = {
+        'version': CACHE_VERSION,
+        'files': fingerprints,
+        'parameters': parameters,
+    }
+    key = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return key, fingerprints
+
+
+def load_cached_frame(output_folder, cache_key):
+    """
+    Load the processed DataFrame from the cache if its key matches.
+
+    Args:
+    - output_folder (str): The directory containing the cache.
+    - cache_key (str): The key expected for the current inputs.
+
+    Returns:
+    - pd.DataFrame: The cached DataFrame, or None if the cache is missing or stale.
+    """
+    cache_path = os.path.join(output_folder, CACHE_FILE)
+    if read_cache_metadata(output_folder).get('key') != cache_key or not os.path.exists(cache_path):
+        return None
+    try:
+        return pd.read_parquet(cache_path)
+    except Exception as e:
+        print(f"Error: {e}. Failed to read the cache, the data will be processed again.")
+        return None
+
+
+def iter_cached_chunks(output_folder, cache_key):
+    """
+    Read the cached DataFrame one Parquet row group at a time.
+
+    In streaming mode each row group is a processed chunk (see save_cached_chunks),
+    so the rows can be used without loading the whole cache.
+
+    Args:
+    - output_folder (str): The directory containing the cache.
+    - cache_key (str): The key expected for the current inputs.
+
+    Yields:
+    - pd.DataFrame: The rows of each row group, in the order of the cache.
+      Nothing is yielded if the cache is missing or stale.
+    """
+    import pyarrow.parquet as pq
+
+    cache_path = os.path.join(output_folder, CACHE_FILE)
+    if read_cache_metadata(output_folder).get('key') != cache_key or not os.path.exists(cache_path):
+        return
+    parquet_file = pq.ParquetFile(cache_path)
+    for index in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(index).to_pandas()
+
+
+def save_cached_frame(df, output_folder, cache_key, fingerprints, **extra):
+    """
+    Save the processed DataFrame and its key in the output folder.
+
+    The DataFrame is written to a temporary file which then replaces the
+    cache, so readers never see a partially written cache.
+
+    Args:
+    - df (pd.DataFrame): The processed DataFrame.
+    - output_folder (str): The directory where the cache is written.
+    - cache_key (str): The key of the current inputs.
+    - fingerprints (list): Fingerprints of the input files.
+    - **extra: Other metadata to save, e.g. the violation counts of the validation.
+    """
+    cache_path = os.path.join(output_folder, CACHE_FILE)
+    temp_path = cache_path + ".tmp"
+    try:
+        df.to_parquet(temp_path, index=False)
+    except Exception as e:
+        print(f"Error: {e}. Failed to write the cache.")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return
+    os.replace(temp_path, cache_path)
+    write_cache_metadata(output_folder, cache_key, fingerprints, **extra)
+
+
+def save_cached_chunks(chunks, output_folder, cache_key, fingerprints, run_report=None, **extra):
+    """
+    Append processed chunks to the cache, one Parquet row group per chunk.
+
+    The chunks are written to a temporary file which replaces the cache only
+    when all of them have been written, so an interrupted run never leaves a
+    partial cache behind.
+
+    Args:
+    - chunks (iterable): Processed DataFrames sharing the same columns.
+    - output_folder (str): The directory where the cache is written.
+    - cache_key (str): The key of the current inputs.
+    - fingerprints (list): Fingerprints of the input files.
+    - run_report (dict): If given, the writes are measured in this run report as the
+      'write_cache' stage, without the time spent producing the chunks.
+    - **extra: Other metadata to save, read once all the chunks are written.
+
+    Returns:
+    - int: Number of rows written, or None if the cache could not be written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    cache_path = os.path.join(output_folder, CACHE_FILE)
+    temp_path = cache_path + ".tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in chunks:
+            if chunk.empty:
+                continue
+            with measure_stage(run_report, 'write_cache', rows_in=len(chunk)):
+                if writer is None:
+                    # The first chunk defines the schema of the whole file
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(temp_path, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                writer.write_table(table)
+            rows += len(chunk)
+    except Exception as e:
+        print(f"Error: {e}. Failed to write the cache.")
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+    if writer is None:
+        print("No rows left after processing, the cache is empty.")
+        return 0
+    with measure_stage(run_report, 'write_cache'):
+        writer.close()
+        os.replace(temp_path, cache_path)
+        write_cache_metadata(output_folder, cache_key, fingerprints, **extra)
+    return rows
+
+
+def load_refreshable_frame(output_folder, base_key):
+    """
+    Load the cached DataFrame and the hashes of its partitions if it can be refreshed.
+
+    The cache can be refreshed only if it was built with the same parameters,
+    which base_key describes, and if the hashes of its partitions were saved
+    with it (see save_partition_hashes). The climate file itself may have
+    changed in any way: the partitions that changed are found from the hashes.
+
+    Args:
+    - output_folder (str): The directory containing the cache.
+    - base_key (str): Key of the parameters of the pipeline.
+
+    Returns:
+    - pd.DataFrame: The cached DataFrame, or None if it can not be refreshed.
+    - pd.DataFrame: The hashes of its partitions, or None.
+    """
+    import pyarrow.parquet as pq
+
+    metadata = read_cache_metadata(output_folder)
+    cache_path = os.path.join(output_folder, CACHE_FILE)
+    hashes_path = os.path.join(output_folder, PARTITION_HASHES_FILE)
+    if metadata.get('base_key') != base_key or not os.path.exists(cache_path):
+        return None, None
+    try:
+        # The hashes must have been saved with the cached DataFrame
+        hashes_key = (pq.read_schema(hashes_path).metadata or {}).get(b'cache_key')
+    except Exception:
+        return None, None
+    if hashes_key is None or hashes_key.decode() != metadata.get('key'):
+        return None, None
+    try:
+        return pd.read_parquet(cache_path), pd.read_parquet(hashes_path)
+    except Exception as e:
+        print(f"Error: {e}. Failed to read the cache, the data will be processed again.")
+        return None, None
+
+
+def save_partition_hashes(hashes, output_folder, cache_key):
+    """
+    Save the hashes of the partitions of the climate data next to the cache.
+
+    The key of the cache is stored in the schema of the Parquet file, so that
+    hashes left by another version of the cache are never used.
+
+    Args:
+    - hashes (pd.DataFrame): The hashes of the partitions, with the 'partition', 'rows'
+      and 'hash' columns (see elaborate_2.hash_partitions).
+    - output_folder (str): The directory containing the cache.
+    - cache_key (str): The key of the cache the hashes were computed with.
+    """
+    hashes_path = os.path.join(output_folder, PARTITION_HASHES_FILE)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    try:
+        table = pa.Table.from_pandas(hashes, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'cache_key': cache_key.encode()})
+        pq.write_table(table, hashes_path + ".tmp")
+    except Exception as e:
+        print(f"Error: {e}. Failed to write the partition hashes.")
+        if os.path.exists(hashes_path + ".tmp"):
+            os.remove(hashes_path + ".tmp")
+        return
+    os.replace(hashes_path + ".tmp", hashes_path)
+
+
+def partition_path(store_path, year, month):
+    """
+    Return the directory of a (year, month) partition of the partitioned store.
+    """
+    return os.path.join(store_path, f'year={year}', f'month={month}')
+
+
+def write_partitioned_store(chunks, output_folder, cache_key):
+    """
+    Write the processed DataFrame as a store partitioned by year and month.
+
+    Each partition is a year=YYYY/month=M directory holding one Parquet file
+    per chunk with rows of that month (part-0.parquet, part-1.parquet, ...),
+    so the chunks are written one at a time. The metadata file lists the
+    partitions with their number of rows and the types of the columns. The
+    store is written in a temporary directory which then replaces the previous store.
+
+    Args:
+    - chunks (iterable): The chunks of the processed DataFrame, in the order of its rows,
+      with 'year' and 'month' columns.
+    - output_folder (str): The directory where the store is written.
+    - cache_key (str): The key of the inputs the DataFrame was computed from.
+    """
+    store_path = os.path.join(output_folder, PARTITIONED_STORE)
+    temp_path = store_path + ".tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    rows = {}
+    dtypes = {}
+    for chunk in chunks:
+        dtypes = dtypes or {column: str(dtype) for column, dtype in chunk.dtypes.items()}
+        for (year, month), partition in chunk.groupby(['year', 'month'], sort=True):
+            year, month = int(year), int(month)
+            path = partition_path(temp_path, year, month)
+            part = len(os.listdir(path)) if os.path.isdir(path) else 0
+            os.makedirs(path, exist_ok=True)
+            # The year and month are encoded in the path of the partition
+            partition.drop(columns=['year', 'month']).to_parquet(os.path.join(path, f'part-{part}.parquet'),
+                                                                 index=False)
+            rows[(year, month)] = rows.get((year, month), 0) + len(partition)
+    os.makedirs(temp_path, exist_ok=True)
+    partitions = [{'year': year, 'month': month, 'rows': count} for (year, month), count in sorted(rows.items())]
+    metadata = {
+        'key': cache_key,
+        'dtypes': dtypes,
+        'partitions': partitions,
+    }
+    with open(os.path.join(temp_path, PARTITIONED_METADATA_FILE), "w", encoding="utf-8") as file:
+        json.dump(metadata, file, indent=2)
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(temp_path, store_path)
+    print(f'Partitioned store written with {len(partitions)} partitions.')
+
+
+def read_partitioned_metadata(output_folder):
+    """
+    Read the metadata of the partitioned store, without loading any partition.
+
+    Args:
+    - output_folder (str): The directory containing the store.
+
+    Returns:
+    - dict: The metadata, empty if there is no store.
+    """
+    metadata_path = os.path.join(output_folder, PARTITIONED_STORE, PARTITIONED_METADATA_FILE)
+    try:
+        with open(metadata_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def read_aggregate_cube_metadata(output_folder):
+    """
+    Read the metadata saved next to the aggregate cube.
+
+    Args:
+    - output_folder (str): The directory containing the cube.
+
+    Returns:
+    - dict: The metadata, empty if there is no cube.
+    """
+    key_path = os.path.join(output_folder, AGGREGATE_CUBE_KEY_FILE)
+    try:
+        with open(key_path, "r", encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def read_aggregate_cube_key(output_folder):
+    """
+    Read the key stored in the schema of the aggregate cube, without loading the cube.
+
+    Args:
+    - output_folder (str): The directory containing the cube.
+
+    Returns:
+    - str: The key of the inputs the cube was computed from, or None if there is no cube.
+    """
+    import pyarrow.parquet as pq
+
+    cube_path = os.path.join(output_folder, AGGREGATE_CUBE_FILE)
+    try:
+        metadata = pq.read_schema(cube_path).metadata or {}
+    except Exception:
+        return None
+    key = metadata.get(b'cube_key')
+    return None if key is None else key.decode()
+
+
+def save_aggregate_cube(cube, productivity_totals, output_folder, cube_key):
+    """
+    Save the aggregate cube, the yearly productivity totals and their key.
+
+    The key is stored in the schema of the Parquet file as well, so that it
+    can be checked without loading the cube (see read_aggregate_cube_key).
+
+    Args:
+    - cube (pd.DataFrame): The aggregate cube.
+    - productivity_totals (dict): Total productivity of each year.
+    - output_folder (str): The directory where the cube is written.
+    - cube_key (str): The key of the inputs the cube was computed from.
+    """
+    cube_path = os.path.join(output_folder, AGGREGATE_CUBE_FILE)
+    key_path = os.path.join(output_folder, AGGREGATE_CUBE_KEY_FILE)
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    try:
+        table = pa.Table.from_pandas(cube, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'cube_key': cube_key.encode()})
+        pq.write_table(table, cube_path + ".tmp")
+        with open(key_path + ".tmp", "w", encoding="utf-8") as file:
+            json.dump({'key': cube_key, 'productivity_totals': productivity_totals}, file, indent=2)
+    except Exception as e:
+        print(f"Error: {e}. Failed to write the aggregate cube.")
+        for path in (cube_path + ".tmp", key_path + ".tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+        return
+    os.replace(cube_path + ".tmp", cube_path)
+    os.replace(key_path + ".tmp", key_path)
+
+
+def load_aggregate_cube(output_folder, cube_key=None):
+    """
+    Load the aggregate cube and the yearly productivity totals.
+
+    Args:
+    - output_folder (str): The directory containing the cube.
+    - cube_key (str): The key expected for the current inputs, as returned by
+      extract_subfile. If None, the cube is loaded whatever its key.
+
+    Returns:
+    - pd.DataFrame: The aggregate cube, or None if it is missing or stale.
+    - dict: Total productivity of each year (int), or None.
+    """
+    metadata = read_aggregate_cube_metadata(output_folder)
+    cube_path = os.path.join(output_folder, AGGREGATE_CUBE_FILE)
+    if not metadata or (cube_key is not None and metadata.get('key') != cube_key) or not os.path.exists(cube_path):
+        return None, None
+    # The table is loaded only when the key in its schema matches too
+    if read_aggregate_cube_key(output_folder) != metadata.get('key'):
+        return None, None
+    try:
+        cube = pd.read_parquet(cube_path)
+    except Exception as e:
+        print(f"Error: {e}. Failed to read the aggregate cube.")
+        return None, None
+    # JSON keys are strings, the years are integers
+    productivity_totals = {int(year): total for year, total in metadata['productivity_totals'].items()}
+    return cube, productivity_totals
+
+
+def make_partition_loader(output_folder, max_partitions=24):
+    """
+    Create a function loading one partition of the partitioned store on demand.
+
+    The loaded partitions are kept in a least-recently-used cache holding at
+    most max_partitions of them; its hits and misses are given by the
+    cache_info() method of the returned function. The returned DataFrames are
+    shared between callers and must not be modified.
+
+    Args:
+    - output_folder (str): The directory containing the store.
+    - max_partitions (int): Maximum number of partitions kept in memory.
+
+    Returns:
+    - function: load_partition(year, month) returning the partition as a DataFrame,
+      empty if the partition does not exist.
+    """
+    store_path = os.path.join(output_folder, PARTITIONED_STORE)
+    metadata = read_partitioned_metadata(output_folder)
+    dtypes = metadata.get('dtypes', {})
+    available = {(partition['year'], partition['month']) for partition in metadata.get('partitions', [])}
+
+    @lru_cache(maxsize=max_partitions)
+    def load_partition(year, month):
+        year, month = int(year), int(month)
+        if (year, month) not in available:
+            return pd.DataFrame(columns=list(dtypes)).astype(dtypes)
+        path = partition_path(store_path, year, month)
+        # The parts hold the rows of the partition in their order
+        parts = sorted(os.listdir(path), key=lambda name: int(name[len('part-'):-len('.parquet')]))
+        df = pd.concat([pd.read_parquet(os.path.join(path, part)) for part in parts], ignore_index=True)
+        df['year'] = year
+        df['month'] = month
+        return df[list(dtypes)].astype({'year': dtypes['year'], 'month': dtypes['month']})
+
+    return load_partition
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+
+# Value written by NASA POWER in place of a missing measurement
+FILL_VALUE = -999
+
+# Checks applied to the climate data before it is processed
+VALIDATION_CHECKS = {
+    # Columns that must be present
+    'required_columns': ['codigo_ibge', 'latitude', 'longitude'],
+    # Columns that must be numeric, the values that can not be converted become NaN.
+    # The key columns are not listed: the CSV parser reads them as integers
+    'numeric_columns': ['latitude', 'longitude', 'TS', 'PS', 'GWETROOT'],
+    # Bounds of the coordinates in the state of Paraná, the rows outside are dropped
+    'bounds': {
+        'latitude': [-26.8, -22.4],
+        'longitude': [-54.7, -47.9],
+    },
+    # Fill values of the measurements, replaced by NaN
+    'fill_values': {
+        'TS': [FILL_VALUE],
+        'PS': [FILL_VALUE],
+        'GWETROOT': [FILL_VALUE],
+    },
+}
+
+
+def count_violation(report, column, check, count):
+    """
+    Add a number of violations of a check on a column to a report.
+
+    Args:
+    - report (dict): Violation counts by column and check, updated in place.
+    - column (str): The column checked.
+    - check (str): The name of the check.
+    - count (int): Number of values violating the check.
+    """
+    column_report = report.setdefault(column, {})
+    column_report[check] = column_report.get(check, 0) + int(count)
+
+
+def validate_frame(df, checks=VALIDATION_CHECKS):
+    """
+    Validate the climate data with vectorized checks.
+
+    The schema is checked first: without a required column the data can not
+    be processed. Then the columns are converted to numbers, the fill values
+    are replaced by NaN and the rows with coordinates out of bounds are
+    dropped, counting the violations of each column.
+
+    Args:
+    - df (pd.DataFrame): The climate DataFrame, raw or processed.
+    - checks (dict): The checks to apply (see VALIDATION_CHECKS).
+
+    Returns:
+    - pd.DataFrame: The validated DataFrame.
+    - dict: Violation counts by column and check.
+    """
+    report = {}
+    missing_columns = [column for column in checks.get('required_columns', []) if column not in df.columns]
+    if missing_columns:
+        for column in missing_columns:
+            count_violation(report, column, 'missing_column', 1)
+        print(f"Error: columns {missing_columns} not found. The data can not be processed.")
+        return df.iloc[0:0], report
+
+    for column in checks.get('numeric_columns', []):
+        if column in df.columns and not pd.api.types.is_numeric_dtype(df[column]):
+            converted = pd.to_numeric(df[column], errors='coerce')
+            count_violation(report, column, 'not_numeric', (converted.isna() & df[column].notna()).sum())
+            df[column] = converted
+
+    for column, fill_values in checks.get('fill_values', {}).items():
+        if column in df.columns:
+            is_fill = np.isin(df[column].to_numpy(), fill_values)
+            count = is_fill.sum()
+            count_violation(report, column, 'fill_value', count)
+            if count:
+                df[column] = df[column].mask(is_fill)
+
+    out_of_bounds = np.zeros(len(df), dtype=bool)
+    for column, (low, high) in checks.get('bounds', {}).items():
+        if column in df.columns:
+            # Missing coordinates are out of bounds too
+            outside = ~df[column].between(low, high).to_numpy()
+            count_violation(report, column, 'out_of_bounds', outside.sum())
+            out_of_bounds |= outside
+    if out_of_bounds.any():
+        df = df[~out_of_bounds].reset_index(drop=True)
+
+    return df, report
+
+
+def merge_validation_reports(report, other):
+    """
+    Add the violation counts of a report, e.g. of a chunk, to another report.
+
+    Args:
+    - report (dict): Violation counts by column and check, updated in place.
+    - other (dict): Violation counts to add.
+
+    Returns:
+    - dict: The updated report.
+    """
+    for column, column_report in other.items():
+        for check, count in column_report.items():
+            count_violation(report, column, check, count)
+    return report
+
+
+def print_validation_report(report):
+    """
+    Print the violation counts of each column.
+
+    Args:
+    - report (dict): Violation counts by column and check.
+    """
+    if not any(count for column_report in report.values() for count in column_report.values()):
+        print('Validation: no violations found.')
+        return
+    table = pd.DataFrame(report).T.fillna(0).astype(int)
+    print('Validation: number of violations of each column')
+    print(table)